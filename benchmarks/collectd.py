@@ -0,0 +1,58 @@
+# Stand-in for the collectd module used by the benchmarks. Values are
+# counted instead of being written anywhere.
+
+DISPATCHED = [0]
+
+
+class Config(object):
+    def __init__(self, key, values=(), children=()):
+        self.key = key
+        self.values = list(values)
+        self.children = list(children)
+
+
+class Values(object):
+    def __init__(self, type=None, plugin=None, plugin_instance="", type_instance="", values=(), meta=None):
+        self.type = type
+        self.plugin = plugin
+        self.plugin_instance = plugin_instance
+        self.type_instance = type_instance
+        self.values = list(values)
+        self.meta = meta or {}
+
+    def dispatch(self, **kwargs):
+        DISPATCHED[0] += 1
+
+
+def reset():
+    count = DISPATCHED[0]
+    DISPATCHED[0] = 0
+    return count
+
+
+def info(msg):
+    pass
+
+
+def debug(msg):
+    pass
+
+
+def warning(msg):
+    print("collectd warning: %s" % msg)
+
+
+def error(msg):
+    print("collectd error: %s" % msg)
+
+
+def register_config(callback, *args, **kwargs):
+    pass
+
+
+def register_read(callback, *args, **kwargs):
+    pass
+
+
+def register_shutdown(callback, *args, **kwargs):
+    pass
@@ -0,0 +1,240 @@
+# Generators of synthetic but realistically shaped Mesos API payloads.
+
+import random
+
+TASK_STATES = (
+    ["TASK_RUNNING"] * 90 + ["TASK_STAGING"] * 3 + ["TASK_STARTING"] * 3 + ["TASK_KILLING", "TASK_FAILED", "TASK_LOST"]
+)
+
+
+def cluster_shape(tasks):
+    """Returns the number of frameworks and agents for a cluster size"""
+    return max(2, tasks // 500), max(3, tasks // 20)
+
+
+def resources(rng):
+    return {
+        "cpus": rng.choice((0.1, 0.25, 0.5, 1.0, 2.0)),
+        "mem": float(rng.choice((128, 256, 512, 1024, 4096))),
+        "disk": float(rng.choice((0, 100, 1024))),
+        "gpus": 0.0,
+        "ports": "[31000-31001]",
+    }
+
+
+def master_snapshot(tasks):
+    frameworks, agents = cluster_shape(tasks)
+    snapshot = {
+        "master/elected": 1.0,
+        "master/uptime_secs": 123456.7,
+        "master/tasks_running": float(tasks),
+        "master/frameworks_active": float(frameworks),
+        "master/slaves_active": float(agents),
+        "system/mem_total_bytes": 67108864000.0,
+    }
+    rng = random.Random(1)
+    for name in ("cpus", "mem", "disk", "gpus"):
+        snapshot["master/%s_total" % name] = float(agents * 16)
+        snapshot["master/%s_used" % name] = float(agents * 8)
+        snapshot["master/%s_percent" % name] = 0.5
+    for i in range(300):
+        snapshot["master/messages_%03d" % i] = float(rng.randint(0, 10**6))
+    for role in range(max(1, frameworks // 4)):
+        snapshot["allocator/mesos/roles/role-%d/shares/dominant" % role] = rng.random()
+    for quantile in ("p50", "p90", "p95", "p99", "p999", "p9999", "min", "max", "count"):
+        snapshot["registrar/state_store_ms/%s" % quantile] = rng.random() * 10
+        snapshot["allocator/mesos/allocation_run_ms/%s" % quantile] = rng.random() * 10
+    return snapshot
+
+
+def framework_list(tasks):
+    frameworks, _ = cluster_shape(tasks)
+    rng = random.Random(2)
+    result = []
+    for i in range(frameworks):
+        used = resources(rng)
+        result.append(
+            {
+                "id": "f5e2a7d0-0000-4000-8000-%012d-%04d" % (i, i),
+                "name": "framework-%d" % i,
+                "active": True,
+                "user": "root",
+                "hostname": "scheduler-%d.example.com" % i,
+                "used_resources": used,
+                "offered_resources": resources(rng),
+                "resources": used,
+                "capabilities": ["PARTITION_AWARE", "MULTI_ROLE"],
+            }
+        )
+    return {"frameworks": result, "completed_frameworks": [], "unregistered_frameworks": []}
+
+
+def task_list(tasks):
+    frameworks, agents = cluster_shape(tasks)
+    rng = random.Random(3)
+    result = []
+    for i in range(tasks):
+        framework = i % frameworks
+        state = rng.choice(TASK_STATES)
+        result.append(
+            {
+                "id": "app-%d.%08x-0000-11e8-8000-000000000000" % (i // 10, i),
+                "name": "app-%d" % (i // 10),
+                "framework_id": "f5e2a7d0-0000-4000-8000-%012d-%04d" % (framework, framework),
+                "executor_id": "",
+                "slave_id": "0b4e0a8c-0000-4000-8000-000000000000-S%d" % (i % agents),
+                "state": state,
+                "resources": resources(rng),
+                "statuses": [
+                    {
+                        "state": state,
+                        "timestamp": 1500000000.0 + i,
+                        "container_status": {
+                            "network_infos": [{"ip_addresses": [{"ip_address": "10.0.%d.%d" % (i % 250, i % 200)}]}]
+                        },
+                    }
+                ],
+                "labels": [{"key": "team", "value": "team-%d" % (framework % 7)}],
+                "container": {
+                    "type": "DOCKER",
+                    "docker": {"image": "registry.example.com/app-%d:1.%d" % (i % 50, i % 3), "network": "BRIDGE"},
+                },
+            }
+        )
+    return {"tasks": result}
+
+
+def v1_resources(resources):
+    result = []
+    for name, value in resources.items():
+        if isinstance(value, float):
+            result.append({"name": name, "type": "SCALAR", "scalar": {"value": value}})
+    return result
+
+
+def v1_task(task):
+    """Returns a /master/tasks entry as a v1 Operator API task"""
+    return {
+        "task_id": {"value": task["id"]},
+        "name": task["name"],
+        "framework_id": {"value": task["framework_id"]},
+        "agent_id": {"value": task["slave_id"]},
+        "state": task["state"],
+        "resources": v1_resources(task["resources"]),
+        "statuses": task["statuses"],
+        "labels": {"labels": task["labels"]},
+        "container": task["container"],
+    }
+
+
+def v1_framework(framework):
+    """Returns a /master/frameworks entry as a v1 Operator API framework"""
+    return {
+        "framework_info": {
+            "id": {"value": framework["id"]},
+            "name": framework["name"],
+            "user": framework["user"],
+            "hostname": framework["hostname"],
+        },
+        "active": framework["active"],
+        "connected": True,
+    }
+
+
+def subscribed(tasks, heartbeat):
+    """Returns the SUBSCRIBED event of a v1 Operator API subscription"""
+    return {
+        "type": "SUBSCRIBED",
+        "subscribed": {
+            "get_state": {
+                "get_tasks": {"tasks": [v1_task(task) for task in task_list(tasks)["tasks"]]},
+                "get_frameworks": {"frameworks": [v1_framework(f) for f in framework_list(tasks)["frameworks"]]},
+            },
+            "heartbeat_interval_seconds": heartbeat,
+        },
+    }
+
+
+def task_updated(task, state):
+    return {
+        "type": "TASK_UPDATED",
+        "task_updated": {
+            "framework_id": {"value": task["framework_id"]},
+            "status": {"task_id": {"value": task["id"]}, "state": state, "timestamp": 1600000000.0},
+            "state": state,
+        },
+    }
+
+
+def agent_id(index):
+    return "0b4e0a8c-0000-4000-8000-000000000000-S%d" % index
+
+
+def agent_snapshot(index):
+    rng = random.Random(index)
+    snapshot = {"slave/registered": 1.0, "slave/uptime_secs": 5000.0 + index}
+    for name in ("cpus", "mem", "disk", "gpus"):
+        snapshot["slave/%s_total" % name] = 32.0
+        snapshot["slave/%s_used" % name] = float(rng.randint(0, 32))
+        snapshot["slave/%s_percent" % name] = rng.random()
+    for state in ("running", "staging", "starting", "failed", "finished", "killed", "lost"):
+        snapshot["slave/tasks_%s" % state] = float(rng.randint(0, 50))
+    for i in range(80):
+        snapshot["containerizer/mesos/metric_%02d" % i] = float(rng.randint(0, 1000))
+    snapshot["system/load_1min"] = rng.random() * 8
+    snapshot["system/mem_free_bytes"] = float(rng.randint(0, 2**36))
+    return snapshot
+
+
+def agent_statistics(index, containers, timestamp):
+    """Returns /monitor/statistics of an agent whose cumulative counters grow
+    with the timestamp"""
+    result = []
+    for i in range(containers):
+        elapsed = timestamp - 1500000000.0
+        result.append(
+            {
+                "container_id": "c-%d-%d" % (index, i),
+                "executor_id": "executor-%d-%d" % (index, i),
+                "executor_name": "Command Executor",
+                "framework_id": "f5e2a7d0-0000-4000-8000-%012d-%04d" % (i, i),
+                "source": "app-%d" % i,
+                "statistics": {
+                    "timestamp": timestamp,
+                    "cpus_limit": 1.1,
+                    "cpus_user_time_secs": elapsed * 0.2,
+                    "cpus_system_time_secs": elapsed * 0.05,
+                    "cpus_throttled_time_secs": elapsed * 0.01,
+                    "mem_limit_bytes": 1073741824,
+                    "mem_rss_bytes": 268435456 + i,
+                    "disk_limit_bytes": 1073741824,
+                    "disk_used_bytes": 1048576,
+                    "net_rx_bytes": int(elapsed * 1000),
+                    "net_tx_bytes": int(elapsed * 500),
+                    "net_rx_packets": int(elapsed * 10),
+                    "net_tx_packets": int(elapsed * 5),
+                    "net_rx_dropped": 0,
+                    "net_tx_dropped": 0,
+                    "net_rx_errors": 0,
+                    "net_tx_errors": 0,
+                },
+            }
+        )
+    return result
+
+
+def slave_list(ports):
+    """Returns /master/slaves for agents listening on the given ports"""
+    slaves = []
+    for index, port in enumerate(ports):
+        slaves.append(
+            {
+                "id": agent_id(index),
+                "pid": "slave(1)@127.0.0.1:%d" % port,
+                "hostname": "agent-%d.example.com" % index,
+                "port": port,
+                "active": True,
+                "resources": {"cpus": 32.0, "mem": 131072.0, "disk": 1048576.0, "gpus": 0.0},
+            }
+        )
+    return {"slaves": slaves}
@@ -0,0 +1,261 @@
+#! /usr/bin/env python3
+"""Replays API responses recorded with CaptureDirectory through the plugin's
+read_callback, using the stub collectd module.
+
+Every captured read is replayed as one read. Responses are served as fast
+as possible, or with their recorded latency and read spacing with
+--realtime. Endpoints not collected during a read are answered with their
+latest earlier capture. Responses are matched on the host they came from
+as well as their path, and the plugin's connections to any host are routed
+to the replay server, so agents collected through the master and a
+followed leader are replayed too. --plugin-dir points at another checkout to compare
+plugin versions on the same input, --profile writes cProfile statistics.
+"""
+
+import argparse
+import cProfile
+import gzip
+import http.server
+import importlib.util
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+CONTROL_PATH = "/__replay/"
+
+
+def load_reads(directory):
+    """Returns (read_dir, read metadata, index entries) of each captured read
+    in the order they were recorded"""
+    reads = []
+    for name in sorted(os.listdir(directory)):
+        read_dir = os.path.join(directory, name)
+        if not name.startswith("read-") or not os.path.exists(os.path.join(read_dir, "read.json")):
+            continue
+        with open(os.path.join(read_dir, "read.json")) as f:
+            meta = json.load(f)
+        entries = []
+        index = os.path.join(read_dir, "index.jsonl")
+        if os.path.exists(index):
+            with open(index) as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        entries.sort(key=lambda entry: entry["started"])
+        reads.append((read_dir, meta, entries))
+    return reads
+
+
+def master_netlocs(reads):
+    """Returns the hosts masters were asked for /master/ endpoints, telling
+    them apart from agents collected through the master"""
+    return set(
+        entry.get("netloc") for _, meta, entries in reads for entry in entries if entry["path"].startswith("/master/")
+    )
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith(CONTROL_PATH):
+            self.server.select(int(self.path[len(CONTROL_PATH) :]))
+            self.respond(200, b"")
+            return
+        if self.path == "/version":
+            self.respond(200, json.dumps({"version": self.server.version}).encode("utf-8"))
+            return
+        if self.path == "/master/redirect" and self.server.leader:
+            self.send_response(307)
+            self.send_header("Location", "//" + self.server.leader)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        response = self.server.response(self.headers.get("Host"), self.path)
+        if response is None:
+            self.respond(404, b"")
+            return
+        latency, status, body = response
+        if self.server.realtime:
+            time.sleep(latency)
+        self.respond(status, body)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, reads, realtime):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), ReplayHandler)
+        self.realtime = realtime
+        self.version = reads[0][1].get("mesos_version") if reads else None
+        # Per read, the latest capture of every host and path up to that
+        # read, and the host the latest master snapshot came from
+        self.served = []
+        latest = {}
+        leader = None
+        masters = master_netlocs(reads)
+        for read_dir, meta, entries in reads:
+            for entry in entries:
+                # Captures without a host are answered for any host
+                latest[(entry.get("netloc"), entry["path"])] = (read_dir, entry)
+                if entry["path"] == "/metrics/snapshot" and entry.get("netloc") in masters:
+                    leader = entry.get("netloc")
+            self.served.append((dict(latest), leader))
+        self.current = {}
+        self.leader = None
+        self.bodies = {}
+
+    def select(self, read):
+        self.current, self.leader = self.served[read]
+        self.bodies = {}
+
+    def response(self, netloc, path):
+        key = (netloc, path)
+        captured = self.current.get(key)
+        if captured is None:
+            key = (None, path)
+            captured = self.current.get(key)
+        if captured is None:
+            return None
+        read_dir, entry = captured
+        body = self.bodies.get(key)
+        if body is None:
+            with gzip.open(os.path.join(read_dir, entry["body"])) as f:
+                body = self.bodies[key] = f.read()
+        return entry["latency"], entry["status"], body
+
+
+def serve(reads, realtime, ports):
+    server = ReplayServer(reads, realtime)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def load_plugin(plugin_dir, master):
+    sys.path.insert(0, plugin_dir)
+    # The stub collectd module takes precedence over any real one
+    sys.path.insert(0, BENCHMARKS)
+    path = os.path.join(plugin_dir, "mesos-master.py" if master else "mesos-slave.py")
+    spec = importlib.util.spec_from_file_location("mesos_plugin", path)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+
+def route_connections(mesos_collectd, port):
+    """Sends the plugin's connections to every host to the replay server,
+    keeping the host they were meant for in the Host header"""
+    base = mesos_collectd.PooledHTTPConnection
+
+    class ReplayConnection(base):
+        def connect(self):
+            self.sock = socket.create_connection(("127.0.0.1", port), self.timeout)
+            self.sock.settimeout(self.read_timeout)
+
+    mesos_collectd.PooledHTTPConnection = ReplayConnection
+
+
+def plugin_options(reads, port):
+    """Configures the plugin to request what was captured"""
+    meta = reads[0][1]
+    entries = [entry for read in reads for entry in read[2]]
+    paths = [entry["path"] for entry in entries]
+    # Captures made before hosts were recorded are served on any host
+    netloc = meta.get("netloc") or "127.0.0.1:%d" % port
+    host, _, configured_port = netloc.rpartition(":")
+    options = [
+        ("Host", host),
+        ("Port", int(configured_port)),
+        ("Path", os.path.join(BENCHMARKS, "missing")),
+        ("Instance", meta["instance"]),
+        ("Cluster", meta["cluster"]),
+        ("ReadTimeout", 600),
+    ]
+    task_paths = [path for path in paths if urllib.parse.urlsplit(path).path == "/master/tasks"]
+    if task_paths:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(task_paths[0]).query)
+        options.append(("TaskPageSize", int(query.get("limit", ["0"])[0])))
+    masters = master_netlocs(reads)
+    elsewhere = [entry for entry in entries if entry.get("netloc", netloc) != netloc]
+    if meta["master"] and "/master/slaves" in paths:
+        options.append(("CollectAgents", True))
+        if any(entry["path"].startswith("/monitor/statistics") for entry in elsewhere):
+            options.append(("AgentContainerStats", True))
+    if meta["master"] and any(entry.get("netloc") in masters for entry in elsewhere):
+        options.append(("FollowLeader", True))
+    if not meta["master"] and any(path.startswith("/monitor/statistics") for path in paths):
+        options.append(("IncludeContainerStats", True))
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="capture directory written by the plugin")
+    parser.add_argument("--realtime", action="store_true", help="replay with the recorded timing")
+    parser.add_argument("--plugin-dir", default=os.path.dirname(BENCHMARKS), help="plugin checkout to replay through")
+    parser.add_argument("--profile", help="write cProfile statistics of the reads to this file")
+    args = parser.parse_args()
+
+    reads = load_reads(args.capture)
+    if not reads:
+        print("No captured reads in %s" % args.capture)
+        return 1
+    plugin = load_plugin(os.path.abspath(args.plugin_dir), reads[0][1]["master"])
+    import collectd
+
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(reads, args.realtime, ports), daemon=True)
+    server.start()
+    try:
+        port = ports.get()
+        route_connections(plugin.mesos_collectd, port)
+        control = "http://127.0.0.1:%d%s" % (port, CONTROL_PATH)
+        options = plugin_options(reads, port)
+        plugin.configure_callback(collectd.Config("Module", children=[collectd.Config(k, [v]) for k, v in options]))
+        profile = cProfile.Profile() if args.profile else None
+        print("%-28s %10s %10s %12s" % ("read", "wall s", "cpu s", "dispatches"))
+        totals = [0.0, 0.0, 0]
+        previous = None
+        for number, (read_dir, meta, entries) in enumerate(reads):
+            urllib.request.urlopen(control + str(number)).read()
+            if args.realtime and previous is not None:
+                # Keep the recorded spacing between the starts of reads
+                time.sleep(max(0.0, previous[0] + meta["time"] - previous[1] - time.perf_counter()))
+            collectd.reset()
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            previous = (wall, meta["time"])
+            if profile is not None:
+                profile.enable()
+            plugin.mesos_collectd.read_callback(plugin.PREFIX)
+            if profile is not None:
+                profile.disable()
+            result = [time.perf_counter() - wall, time.process_time() - cpu, collectd.reset()]
+            print("%-28s %10.3f %10.3f %12d" % (os.path.basename(read_dir), result[0], result[1], result[2]))
+            totals = [total + value for total, value in zip(totals, result)]
+        print("%-28s %10.3f %10.3f %12d" % ("total", totals[0], totals[1], totals[2]))
+        if profile is not None:
+            profile.dump_stats(args.profile)
+        plugin.shutdown_callback()
+    finally:
+        server.terminate()
+        server.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
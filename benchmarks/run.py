@@ -0,0 +1,244 @@
+#! /usr/bin/env python3
+"""Benchmarks the read, parse and dispatch pipeline of the master plugin
+against a stand-in master serving a synthetic cluster.
+
+Reports wall time, CPU time, peak memory and dispatches per second of
+read_callback end to end and of the get_json, parse_task_stats,
+dispatch_stat and operator_index stages, and exits non-zero when a result regresses past the
+stored baselines by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+# The stub collectd module takes precedence over any real one
+sys.path.insert(0, BENCHMARKS)
+
+import collectd  # noqa: E402
+import mesos_collectd  # noqa: E402
+import payloads  # noqa: E402
+import server  # noqa: E402
+
+SIZES = {"1k": 1000, "10k": 10000, "100k": 100000, "1m": 1000000}
+DEFAULT_SIZES = "1k,10k,100k"
+BASELINES = os.path.join(BENCHMARKS, "baselines.json")
+# Results compared against the baselines, larger is worse for all of them,
+# with an absolute slack so that near zero results do not flap
+CHECKED = {"wall_s": 0.005, "cpu_s": 0.005, "peak_mib": 1.0}
+
+
+def load_plugin():
+    path = os.path.join(os.path.dirname(BENCHMARKS), "mesos-master.py")
+    spec = importlib.util.spec_from_file_location("mesos_master", path)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+
+def configure(plugin, port, subscribe=False, agents=False, extra=()):
+    """Configures a single plugin instance against the stand-in master"""
+    del mesos_collectd.CONFIGS[:]
+    mesos_collectd.HTTP_POOL.close_all()
+    options = [
+        ("Host", "127.0.0.1"),
+        ("Port", port),
+        ("Path", os.path.join(BENCHMARKS, "missing")),
+        ("ReadTimeout", 600),
+        ("ReadDeadline", 3600),
+        ("Subscribe", subscribe),
+        ("CollectAgents", agents),
+        ("AgentContainerStats", agents),
+    ]
+    options.extend(extra)
+    plugin.configure_callback(collectd.Config("Module", children=[collectd.Config(k, [v]) for k, v in options]))
+    return mesos_collectd.CONFIGS[0]
+
+
+def measure(stage, repeat):
+    """Runs a stage once to warm up, repeat times for timing and once more
+    under tracemalloc for its peak memory"""
+    stage()
+    walls = []
+    cpus = []
+    dispatched = 0
+    for _ in range(repeat):
+        collectd.reset()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        stage()
+        cpus.append(time.process_time() - cpu)
+        walls.append(time.perf_counter() - wall)
+        dispatched = collectd.reset()
+    tracemalloc.start()
+    try:
+        stage()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    collectd.reset()
+    wall = statistics.median(walls)
+    return {
+        "wall_s": wall,
+        "cpu_s": statistics.median(cpus),
+        "peak_mib": peak / 1048576.0,
+        "dispatches": dispatched,
+        "dispatches_per_s": dispatched / wall if wall else 0.0,
+    }
+
+
+def read(plugin):
+    """Reads every instance the plugin configured, as collectd would"""
+    mesos_collectd.read_callback(plugin.PREFIX)
+
+
+def wait_for_subscription(plugin, conf, timeout=600):
+    """Reads until tasks and frameworks come from the Operator API index"""
+    deadline = time.monotonic() + timeout
+    while not conf["subscriber"].synced:
+        if time.monotonic() > deadline:
+            raise RuntimeError("The Operator API subscription did not get in sync")
+        read(plugin)
+        time.sleep(0.1)
+    read(plugin)
+
+
+def bench_discovery(plugin, port, tasks, repeat):
+    """Measures parse_stats with DiscoverStats and the default stat
+    templates, checking that every numeric snapshot key is sent"""
+    conf = configure(plugin, port, extra=(("DiscoverStats", True), ("DefaultStatsTemplates", True)))
+    snapshot = payloads.master_snapshot(tasks)
+    result = measure(lambda: mesos_collectd.parse_stats(conf, snapshot), repeat)
+    if result["dispatches"] != len(snapshot):
+        raise RuntimeError(
+            "parse_stats sent %d values for %d discovered snapshot keys" % (result["dispatches"], len(snapshot))
+        )
+    return result
+
+
+def bench_size(plugin, size, tasks, repeat, subscribe=False, event_rate=0, agents=0, containers=0):
+    # Subscriptions and agents change the cost of every stage, keep their
+    # results apart
+    mode = "+subscribe" if subscribe else ""
+    if agents:
+        mode += "+%dagents" % agents
+    results = {}
+    with contextlib.ExitStack() as stack:
+        agent_ports = []
+        if agents:
+            agent_ports = stack.enter_context(server.AgentStandIns(agents, containers)).ports
+        stand_in = stack.enter_context(server.StandIn(tasks, event_rate, agent_ports))
+        conf = configure(plugin, stand_in.port, subscribe, bool(agents))
+        # Warm up the connection pool, metric plan and caches
+        read(plugin)
+        if subscribe:
+            wait_for_subscription(plugin, conf)
+        results["read_callback%s/%s" % (mode, size)] = measure(lambda: read(plugin), repeat)
+        unpaged = conf["task_url"]
+        results["get_json%s/%s" % (mode, size)] = measure(
+            lambda: mesos_collectd.get_json(unpaged, conf, conf["ssl_context"]), repeat
+        )
+        mesos_collectd.shutdown_callback()
+        results["parse_stats+discover%s/%s" % (mode, size)] = bench_discovery(plugin, stand_in.port, tasks, repeat)
+        mesos_collectd.shutdown_callback()
+    document = payloads.task_list(tasks)
+    results["parse_task_stats%s/%s" % (mode, size)] = measure(
+        lambda: mesos_collectd.parse_task_stats(conf, document), repeat
+    )
+    key = mesos_collectd.Stat("gauge", "resources.cpus")
+    dimensions = [{"mesos_task_id": task["id"]} for task in document["tasks"]]
+
+    def dispatch():
+        for dims in dimensions:
+            mesos_collectd.dispatch_stat(0.5, "task.resources.cpus", key, conf, dims)
+
+    results["dispatch_stat%s/%s" % (mode, size)] = measure(dispatch, repeat)
+    event = payloads.subscribed(tasks, 15)
+    results["operator_index%s/%s" % (mode, size)] = measure(lambda: mesos_collectd.OperatorIndex().apply(event), repeat)
+    return results
+
+
+def report(results):
+    print("%-32s %10s %10s %10s %12s %14s" % ("stage", "wall s", "cpu s", "peak MiB", "dispatches", "dispatches/s"))
+    for name, result in results.items():
+        print(
+            "%-32s %10.3f %10.3f %10.1f %12d %14.0f"
+            % (
+                name,
+                result["wall_s"],
+                result["cpu_s"],
+                result["peak_mib"],
+                result["dispatches"],
+                result["dispatches_per_s"],
+            )
+        )
+
+
+def regressions(results, baselines, tolerance):
+    found = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        for field, slack in CHECKED.items():
+            if field in baseline and result[field] > baseline[field] * (1 + tolerance) + slack:
+                found.append("%s %s %.3f exceeds baseline %.3f" % (name, field, result[field], baseline[field]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="cluster sizes out of %s" % ",".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage, the median is reported")
+    parser.add_argument("--baselines", default=BASELINES, help="baseline results file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression as a fraction")
+    parser.add_argument("--subscribe", action="store_true", help="read tasks through an Operator API subscription")
+    parser.add_argument("--event-rate", type=int, default=100, help="task updates per second sent to subscribers")
+    parser.add_argument("--agents", type=int, default=0, help="stand-in agents to collect from through the master")
+    parser.add_argument("--containers", type=int, default=4, help="executors reported by each stand-in agent")
+    parser.add_argument("--save-baselines", action="store_true", help="store the results as the new baselines")
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    results = {}
+    for size in args.sizes.lower().split(","):
+        results.update(
+            bench_size(
+                plugin,
+                size,
+                SIZES[size],
+                args.repeat,
+                args.subscribe,
+                args.event_rate,
+                args.agents,
+                args.containers,
+            )
+        )
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    report(results)
+
+    if args.save_baselines:
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        return 0
+    found = regressions(results, baselines, args.tolerance)
+    for regression in found:
+        print("REGRESSION: %s" % regression)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+# Local stand-in for a Mesos master serving synthetic payloads.
+
+import http.server
+import json
+import multiprocessing
+import random
+import selectors
+import time
+import urllib.parse
+
+import payloads
+
+
+class MesosHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.server.body(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        call = json.loads(self.rfile.read(length) or b"{}")
+        if self.path != "/api/v1" or call.get("type") != "SUBSCRIBE":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            self.send_record(self.server.subscribed())
+            self.server.stream_events(self.send_record)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_record(self, event):
+        """Writes an event as a RecordIO record in a chunk of its own"""
+        record = json.dumps(event).encode("utf-8")
+        record = b"%d\n%s" % (len(record), record)
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(record), record))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MesosServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Seconds between heartbeats of an Operator API subscription
+    heartbeat = 15.0
+
+    def __init__(self, tasks, event_rate=0, agent_ports=()):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), MesosHandler)
+        self.task_count = tasks
+        self.event_rate = event_rate
+        self.documents = {
+            "/version": {"version": "1.5.0"},
+            "/metrics/snapshot": payloads.master_snapshot(tasks),
+            "/master/frameworks": payloads.framework_list(tasks),
+            "/master/slaves": payloads.slave_list(agent_ports),
+        }
+        self.tasks = payloads.task_list(tasks)["tasks"]
+        self.bodies = {}
+
+    def body(self, path):
+        """Returns the encoded response for a request path, encoding every
+        document once so that serving costs as little as possible"""
+        if path not in self.bodies:
+            url = urllib.parse.urlsplit(path)
+            if url.path == "/master/tasks":
+                query = urllib.parse.parse_qs(url.query)
+                offset = int(query.get("offset", ["0"])[0])
+                limit = int(query.get("limit", [str(len(self.tasks))])[0])
+                document = {"tasks": self.tasks[offset : offset + limit]}
+            elif url.path in self.documents:
+                document = self.documents[url.path]
+            else:
+                return None
+            self.bodies[path] = json.dumps(document).encode("utf-8")
+        return self.bodies[path]
+
+    def subscribed(self):
+        return payloads.subscribed(self.task_count, self.heartbeat)
+
+    def stream_events(self, send):
+        """Sends TASK_UPDATED events for random tasks at the event rate, in
+        batches every tenth of a second, and heartbeats"""
+        rng = random.Random(4)
+        heartbeat_at = time.monotonic() + self.heartbeat
+        while True:
+            time.sleep(0.1)
+            for _ in range(int(self.event_rate / 10)):
+                task = rng.choice(self.tasks)
+                send(payloads.task_updated(task, rng.choice(payloads.TASK_STATES)))
+            if time.monotonic() >= heartbeat_at:
+                send({"type": "HEARTBEAT"})
+                heartbeat_at += self.heartbeat
+
+
+def serve(tasks, ports, event_rate=0, agent_ports=()):
+    server = MesosServer(tasks, event_rate, agent_ports)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandIn(object):
+    """Runs a stand-in master for a cluster of the given number of tasks in
+    a child process, so serving does not count against the plugin. Operator
+    API subscribers get event_rate task updates per second."""
+
+    def __init__(self, tasks, event_rate=0, agent_ports=()):
+        self.tasks = tasks
+        self.event_rate = event_rate
+        self.agent_ports = list(agent_ports)
+        self.process = None
+        self.port = None
+
+    def __enter__(self):
+        ports = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=serve, args=(self.tasks, ports, self.event_rate, self.agent_ports), daemon=True
+        )
+        self.process.start()
+        self.port = ports.get()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+
+class AgentHandler(http.server.BaseHTTPRequestHandler):
+    # One request per connection, so that a single thread can serve them all
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        index = self.server.index
+        if self.path == "/version":
+            body = b'{"version": "1.5.0"}'
+        elif self.path == "/metrics/snapshot":
+            body = self.server.snapshot
+        elif self.path == "/monitor/statistics":
+            statistics = payloads.agent_statistics(index, self.server.containers, time.time())
+            body = json.dumps(statistics).encode("utf-8")
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_agents(count, containers, ports):
+    """Runs count stand-in agents, each on a port of its own, from a single
+    thread multiplexing all of their listening sockets"""
+    selector = selectors.DefaultSelector()
+    servers = []
+    for index in range(count):
+        server = http.server.HTTPServer(("127.0.0.1", 0), AgentHandler)
+        server.index = index
+        server.containers = containers
+        server.snapshot = json.dumps(payloads.agent_snapshot(index)).encode("utf-8")
+        selector.register(server.socket, selectors.EVENT_READ, server)
+        servers.append(server)
+    ports.put([server.server_address[1] for server in servers])
+    while True:
+        for key, _ in selector.select():
+            key.data._handle_request_noblock()
+
+
+class AgentStandIns(object):
+    """Runs stand-in agents in a child process"""
+
+    def __init__(self, count, containers=0):
+        self.count = count
+        self.containers = containers
+        self.process = None
+        self.ports = []
+
+    def __enter__(self):
+        ports = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=serve_agents, args=(self.count, self.containers, ports), daemon=True
+        )
+        self.process.start()
+        self.ports = ports.get()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
@@ -251,22 +251,30 @@ DIMENSIONS_MESOS = {
         'mesos_agent': 'slave_id',
         'mesos_task_id': 'id',
         'container_image': 'container.docker.image'
-    }
+    },
+    "CONTAINER": mesos_collectd.CONTAINER_DIMENSIONS
 }
 
 
+TABLES = mesos_collectd.MetricTables(
+    STATS_MESOS, STATS_MESOS_019, STATS_MESOS_020, STATS_MESOS_021,
+    STATS_MESOS_022, STATS_MESOS_100, frameworks=FRAMEWORK_MESOS,
+    tasks=TASK_MESOS, dimensions=DIMENSIONS_MESOS,
+    containers=mesos_collectd.CONTAINER_STATS,
+    container_rates=mesos_collectd.CONTAINER_RATE_STATS)
+
+
 def configure_callback(conf):
+    # Each Module block registers its own read callback
     mesos_collectd.configure_callback(conf, IS_MASTER, PREFIX, MESOS_CLUSTER,
                                       MESOS_INSTANCE, MESOS_PATH, MESOS_HOST,
-                                      MESOS_PORT, MESOS_URL, VERBOSE_LOGGING)
+                                      MESOS_PORT, MESOS_URL, VERBOSE_LOGGING,
+                                      TABLES)
 
 
-def read_callback():
-    mesos_collectd.read_callback(IS_MASTER, STATS_MESOS, STATS_MESOS_019,
-                                 STATS_MESOS_020, STATS_MESOS_021,
-                                 STATS_MESOS_022, STATS_MESOS_100,
-                                 FRAMEWORK_MESOS, TASK_MESOS, DIMENSIONS_MESOS)
+def shutdown_callback():
+    mesos_collectd.shutdown_callback()
 
 
 collectd.register_config(configure_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -106,18 +106,29 @@ STATS_MESOS_100 = {
     'slave/gpus_used': Stat("gauge", "slave/gpus_used")
 }
 
+DIMENSIONS_MESOS = {
+    "CONTAINER": mesos_collectd.CONTAINER_DIMENSIONS
+}
+
+
+TABLES = mesos_collectd.MetricTables(
+    STATS_MESOS, STATS_MESOS_019, STATS_MESOS_020, STATS_MESOS_021,
+    STATS_MESOS_022, STATS_MESOS_100, dimensions=DIMENSIONS_MESOS,
+    containers=mesos_collectd.CONTAINER_STATS,
+    container_rates=mesos_collectd.CONTAINER_RATE_STATS)
+
 
 def configure_callback(conf):
+    # Each Module block registers its own read callback
     mesos_collectd.configure_callback(conf, IS_MASTER, PREFIX, MESOS_CLUSTER,
                                       MESOS_INSTANCE, MESOS_PATH, MESOS_HOST,
-                                      MESOS_PORT, MESOS_URL, VERBOSE_LOGGING)
+                                      MESOS_PORT, MESOS_URL, VERBOSE_LOGGING,
+                                      TABLES)
 
 
-def read_callback():
-    mesos_collectd.read_callback(IS_MASTER, STATS_MESOS, STATS_MESOS_019,
-                                 STATS_MESOS_020, STATS_MESOS_021,
-                                 STATS_MESOS_022, STATS_MESOS_100)
+def shutdown_callback():
+    mesos_collectd.shutdown_callback()
 
 
 collectd.register_config(configure_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -2,34 +2,120 @@
 #
 # Common functions for master and slave plugins.
 
+import array
+import base64
+import codecs
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import gzip
+import http.client
+import io
 import json
+import math
 import os
+import random
+import re
+import shutil
+import socket
 import ssl
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import urllib.error
 import urllib.parse
-import urllib.request
-from functools import reduce
+import zlib
 
 import collectd
 
 CONFIGS = []
 
+Stat = collections.namedtuple("Stat", ("type", "path"))
+
+# Counters of the shared HTTP connection pool, reported per config host
+HTTP_POOL_STATS = {
+    "plugin.http_pool.hits": Stat("counter", "hits"),
+    "plugin.http_pool.misses": Stat("counter", "misses"),
+    "plugin.http_pool.stale": Stat("counter", "stale"),
+}
+
+# Per-executor gauges from agents' /monitor/statistics, shared by the agent
+# plugin and the master plugin collecting from its agents
+CONTAINER_STATS = {
+    "executor.cpus.limit": Stat("gauge", "statistics.cpus_limit"),
+    "executor.mem.limit_bytes": Stat("bytes", "statistics.mem_limit_bytes"),
+    "executor.mem.rss_bytes": Stat("bytes", "statistics.mem_rss_bytes"),
+    "executor.disk.limit_bytes": Stat("bytes", "statistics.disk_limit_bytes"),
+    "executor.disk.used_bytes": Stat("bytes", "statistics.disk_used_bytes"),
+}
+
+# Per-second rates of cumulative fields from /monitor/statistics
+CONTAINER_RATE_STATS = {
+    "executor.cpus.user_time_per_sec": Stat("gauge", "statistics.cpus_user_time_secs"),
+    "executor.cpus.system_time_per_sec": Stat("gauge", "statistics.cpus_system_time_secs"),
+    "executor.cpus.throttled_time_per_sec": Stat("gauge", "statistics.cpus_throttled_time_secs"),
+    "executor.net.rx_bytes_per_sec": Stat("gauge", "statistics.net_rx_bytes"),
+    "executor.net.tx_bytes_per_sec": Stat("gauge", "statistics.net_tx_bytes"),
+    "executor.net.rx_packets_per_sec": Stat("gauge", "statistics.net_rx_packets"),
+    "executor.net.tx_packets_per_sec": Stat("gauge", "statistics.net_tx_packets"),
+    "executor.net.rx_dropped_per_sec": Stat("gauge", "statistics.net_rx_dropped"),
+    "executor.net.tx_dropped_per_sec": Stat("gauge", "statistics.net_tx_dropped"),
+    "executor.net.rx_errors_per_sec": Stat("gauge", "statistics.net_rx_errors"),
+    "executor.net.tx_errors_per_sec": Stat("gauge", "statistics.net_tx_errors"),
+}
+
+# Dimensions of the container metrics
+CONTAINER_DIMENSIONS = {
+    "mesos_framework_id": "framework_id",
+    "mesos_executor_id": "executor_id",
+    "mesos_executor_name": "executor_name",
+}
+
+# Metric tables of a plugin (master or agent), handed to each instance it
+# configures. Container tables are read by agents and by masters collecting
+# from their agents.
+MetricTables = collections.namedtuple(
+    "MetricTables",
+    (
+        "stats",
+        "stats_019",
+        "stats_020",
+        "stats_021",
+        "stats_022",
+        "stats_100",
+        "frameworks",
+        "tasks",
+        "dimensions",
+        "containers",
+        "container_rates",
+    ),
+    defaults=(None, None, None, None, None),
+)
+
+# Maximum number of endpoint requests issued in parallel during a read
+FETCH_CONCURRENCY = 4
+
+# Tasks requested per /master/tasks page, 0 requests the endpoint unpaged
+TASK_PAGE_SIZE = 1000
+
 
 # FUNCTION: gets the list of stats based on the version of mesos
-def get_stats_string(version):
+def get_stats_string(tables, version):
     if version == "0.19.0" or version == "0.19.1":
-        stats_cur = dict(list(STATS_MESOS.items()) + list(STATS_MESOS_019.items()))
+        stats_cur = dict(list(tables.stats.items()) + list(tables.stats_019.items()))
     elif version == "0.20.0" or version == "0.20.1":
-        stats_cur = dict(list(STATS_MESOS.items()) + list(STATS_MESOS_020.items()))
+        stats_cur = dict(list(tables.stats.items()) + list(tables.stats_020.items()))
     elif version == "0.21.0" or version == "0.21.1":
-        stats_cur = dict(list(STATS_MESOS.items()) + list(STATS_MESOS_021.items()))
+        stats_cur = dict(list(tables.stats.items()) + list(tables.stats_021.items()))
     elif version == "0.22.0" or version == "0.22.1":
-        stats_cur = dict(list(STATS_MESOS.items()) + list(STATS_MESOS_022.items()))
+        stats_cur = dict(list(tables.stats.items()) + list(tables.stats_022.items()))
     elif version == "1.0.0" or version == "1.0.1":
-        stats_cur = dict(list(STATS_MESOS.items()) + list(STATS_MESOS_100.items()))
+        stats_cur = dict(list(tables.stats.items()) + list(tables.stats_100.items()))
     else:
-        stats_cur = dict(list(STATS_MESOS.items()) + list(STATS_MESOS_022.items()))
+        stats_cur = dict(list(tables.stats.items()) + list(tables.stats_022.items()))
 
     return stats_cur
 
@@ -42,88 +128,258 @@ def _d(d):
 
 
 # FUNCTION: gets the list of framework metrics based on the version of mesos
-def get_framework_string(version):
-    stats_cur = dict(list(FRAMEWORK_MESOS.items()))
+def get_framework_string(tables, version):
+    stats_cur = dict(list(tables.frameworks.items()))
     return stats_cur
 
 
 # FUNCTION: gets the list of task metrics based on the version of mesos
-def get_task_string(version):
-    stats_cur = dict(list(TASK_MESOS.items()))
+def get_task_string(tables, version):
+    stats_cur = dict(list(tables.tasks.items()))
     return stats_cur
 
 
-def get_dimension_string(version):
-    dimensions_cur = dict(list(DIMENSIONS_MESOS.items()))
+def get_dimension_string(tables, version):
+    dimensions_cur = dict(list(tables.dimensions.items()))
     return dimensions_cur
 
 
-def lookup_framework_stat(stat, json, conf):
-    try:
-        val = dig_it_up(json, get_framework_string(conf["version"])[stat].path)
-    except KeyError as e:
-        val = None
-        log_verbose(
-            conf.get("verboseLogging", False),
-            "Encountered key error {0} while looking up framework stat {1}".format(e, stat),
-        )
-        val = None
-    return val
+# A metric plan holds every stat and dimension lookup for one Mesos version,
+# with dotted paths already split, so the parse functions only iterate.
+MetricPlan = collections.namedtuple(
+    "MetricPlan",
+    (
+        "version",
+        "stats",
+        "elected",
+        "frameworks",
+        "framework_dimensions",
+        "tasks",
+        "task_dimensions",
+        "containers",
+        "container_rates",
+        "container_dimensions",
+    ),
+)
+PlannedStat = collections.namedtuple("PlannedStat", ("name", "key", "path", "convert", "get"))
+# Dimension names of an entity with their pre-split paths and accessors
+PlannedDimensions = collections.namedtuple("PlannedDimensions", ("names", "paths", "getters"))
+
+TASK_STATE_MAPPING = {
+    "TASK_RUNNING": 0,
+    "TASK_FINISHED": 1,
+    "TASK_STAGING": 2,
+    "TASK_STARTING": 3,
+    "TASK_KILLING": 4,
+    "TASK_LOST": 5,
+    "TASK_KILLED": 6,
+    "TASK_FAILED": 7,
+    "TASK_ERROR": 8,
+}
+
+
+def _convert_task_state(state):
+    return TASK_STATE_MAPPING.get(state, 9)
+
+
+def _convert_is_active(active):
+    if active is None:
+        return None
+    return int(active)
 
 
-def lookup_task_stat(stat, json, conf):
-    try:
-        val = dig_it_up(json, get_task_string(conf["version"])[stat].path)
-    except KeyError as e:
-        log_verbose(
-            conf.get("verboseLogging", False),
-            "Encountered key error {0} while looking up task stat {1}".format(e, stat),
-        )
-        val = None
-    return val
+# Per-stat patches applied to the raw value before dispatch
+STAT_CONVERTERS = {
+    "framework.is_active": _convert_is_active,
+    "task.state": _convert_task_state,
+}
 
 
-# FUNCTION: Collect stats from JSON result
-def lookup_stat(stat, json, conf):
-    try:
-        val = dig_it_up(json, get_stats_string(conf["version"])[stat].path)
-    except KeyError as e:
+def _split_path(path):
+    if isinstance(path, (str, bytes)):
+        return tuple(path.split("."))
+    return tuple(path)
+
+
+def compile_accessor(path):
+    """Returns a function looking up a pre-split path in a decoded object,
+    or None where a part is missing, like dig_it_up but without iterating
+    for the one and two part paths of the metric tables"""
+    if len(path) == 1:
+        (key,) = path
+
+        def get(obj):
+            try:
+                return obj[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+
+    elif len(path) == 2:
+        first, second = path
+
+        def get(obj):
+            try:
+                return obj[first][second]
+            except (KeyError, IndexError, TypeError):
+                return None
+
+    else:
+
+        def get(obj):
+            return dig_it_up(obj, path)
+
+    return get
+
+
+def _plan_stats(stats):
+    planned = []
+    for name, key in stats.items():
+        path = _split_path(key.path)
+        planned.append(PlannedStat(name, key, path, STAT_CONVERTERS.get(name), compile_accessor(path)))
+    return tuple(planned)
+
+
+def _plan_dimensions(dimensions):
+    paths = tuple(_split_path(path) for path in dimensions.values())
+    return PlannedDimensions(tuple(dimensions), paths, tuple(compile_accessor(path) for path in paths))
+
+
+NO_DIMENSIONS = PlannedDimensions((), (), ())
+
+
+def compile_metric_plan(tables, version):
+    """Resolves the metric tables for a Mesos version into a MetricPlan."""
+    stats = _plan_stats(get_stats_string(tables, version))
+    elected = None
+    for planned in stats:
+        if planned.name == "master/elected":
+            elected = planned
+    frameworks = ()
+    tasks = ()
+    containers = ()
+    container_rates = ()
+    framework_dimensions = NO_DIMENSIONS
+    task_dimensions = NO_DIMENSIONS
+    container_dimensions = NO_DIMENSIONS
+    if tables.frameworks:
+        frameworks = _plan_stats(get_framework_string(tables, version))
+    if tables.tasks:
+        tasks = _plan_stats(get_task_string(tables, version))
+    if tables.containers:
+        containers = _plan_stats(tables.containers)
+    if tables.container_rates:
+        container_rates = _plan_stats(tables.container_rates)
+    if tables.dimensions:
+        dimensions = get_dimension_string(tables, version)
+        framework_dimensions = _plan_dimensions(dimensions.get("FRAMEWORK", {}))
+        task_dimensions = _plan_dimensions(dimensions.get("TASK", {}))
+        container_dimensions = _plan_dimensions(dimensions.get("CONTAINER", {}))
+    return MetricPlan(
+        version,
+        stats,
+        elected,
+        frameworks,
+        framework_dimensions,
+        tasks,
+        task_dimensions,
+        containers,
+        container_rates,
+        container_dimensions,
+    )
+
+
+def get_metric_plan(conf):
+    """Returns the compiled metric plan for a config, building it on first use."""
+    plan = conf.get("metric_plan")
+    if plan is None:
+        plan = compile_metric_plan(conf["tables"], conf["mesos_version"])
+        conf["metric_plan"] = plan
         log_verbose(
-            conf.get("verboseLogging", False), "Encountered key error {0} while looking up stats {1}".format(e, stat)
+            conf,
+            "Compiled metric plan for version %s: %d stats, %d framework stats, %d task stats"
+            % (plan.version, len(plan.stats), len(plan.frameworks), len(plan.tasks)),
         )
-        val = None
-    # Check to make sure we have a valid result
-    # dig_it_up returns None if no match found
+    return plan
+
+
+def intern_value(value):
+    """Returns a dimension value as a string shared with every other entity
+    carrying the same value, such as a framework, agent or image."""
+    if value.__class__ is not str:
+        value = str(value)
+    return sys.intern(value)
+
+
+def dimension_values(obj, planned_dimensions):
+    """Returns the dimension values of a framework or task, in the order of
+    planned_dimensions.names"""
+    return tuple([intern_value(get(obj)) for get in planned_dimensions.getters])
+
+
+def extract_dimensions(obj, planned_dimensions):
+    """Builds the dimension dictionary for a framework or task."""
+    return dict(zip(planned_dimensions.names, dimension_values(obj, planned_dimensions)))
+
+
+def lookup_planned_stat(planned, json):
+    """Looks up a planned stat and applies its converter, if any."""
+    val = planned.get(json)
+    if planned.convert is not None:
+        val = planned.convert(val)
     return val
 
 
-def configure_callback(conf, is_master, prefix, cluster, instance, path, host, port, url, verboseLogging):
-    """Received configuration information"""
-    global ELECTED
-    ELECTED = 0
-    global PREFIX
-    PREFIX = prefix
-    global MESOS_CLUSTER
-    MESOS_CLUSTER = cluster
-    global MESOS_INSTANCE
-    MESOS_INSTANCE = instance
-    global MESOS_PATH
-    MESOS_PATH = path
-    global MESOS_HOST
-    MESOS_HOST = host
-    global MESOS_PORT
-    MESOS_PORT = port
-    global MESOS_URL
-    MESOS_URL = url
-    global VERBOSE_LOGGING
-    VERBOSE_LOGGING = verboseLogging
+def configure_callback(conf, is_master, prefix, cluster, instance, path, host, port, url, verboseLogging, tables=None):
+    """Received configuration information. Every Module block becomes a
+    PluginInstance with its own read callback."""
     include_system_health = False
+    include_container_stats = False
+    discover_stats = False
+    stats_include = []
+    stats_exclude = []
+    stat_templates = []
     system_health_url = None
     scheme = "http"
     dcos_sfx_username = None
     dcos_sfx_password = None
     dcos_url = None
+    token_cache_file = DCOS_TOKEN_CACHE_FILE
     ca_file_path = None
+    stream_responses = True
+    task_page_size = TASK_PAGE_SIZE
+    task_page_parallelism = 1
+    task_rollups = []
+    per_task_metrics = True
+    per_task_allowlist = []
+    task_sample_rate = 1.0
+    framework_sample_rates = []
+    suppress_unchanged = False
+    heartbeat_interval = HEARTBEAT_INTERVAL
+    self_metrics = False
+    subscribe = False
+    collect_agents = False
+    agent_refresh_interval = AGENT_REFRESH_INTERVAL
+    agent_concurrency = AGENT_CONCURRENCY
+    agent_keep_alive = False
+    agent_container_stats = False
+    agent_stats_include = []
+    agent_stats_exclude = []
+    compress_responses = True
+    capture_directory = None
+    capture_reads = CAPTURE_READS
+    follow = False
+    connect_timeout = CONNECT_TIMEOUT
+    read_timeout = READ_TIMEOUT
+    read_deadline = None
+    breaker_threshold = BREAKER_THRESHOLD
+    breaker_backoff = BREAKER_BACKOFF
+    breaker_max_backoff = BREAKER_MAX_BACKOFF
+    intervals = {}
+    interval_jitter = INTERVAL_JITTER
+    streaming_threshold = STREAMING_THRESHOLD
+    fetch_concurrency = FETCH_CONCURRENCY
+    read_interval = None
+    multi_value_resources = False
 
     for node in conf.children:
         if node.key == "Host":
@@ -140,6 +396,19 @@ def configure_callback(conf, is_master, prefix, cluster, instance, path, host, p
             path = node.values[0]
         elif node.key == "IncludeSystemHealth":
             include_system_health = node.values[0]
+        elif node.key == "IncludeContainerStats":
+            include_container_stats = bool(node.values[0])
+        elif node.key == "DiscoverStats":
+            discover_stats = bool(node.values[0])
+        elif node.key == "StatsInclude":
+            stats_include.extend(node.values)
+        elif node.key == "StatsExclude":
+            stats_exclude.extend(node.values)
+        elif node.key == "StatsTemplate":
+            stat_templates.extend(node.values)
+        elif node.key == "DefaultStatsTemplates":
+            if node.values[0]:
+                stat_templates.extend(DEFAULT_STAT_TEMPLATES)
         elif node.key == "dcos_sfx_username":
             dcos_sfx_username = node.values[0]
         elif node.key == "dcos_sfx_password":
@@ -150,17 +419,100 @@ def configure_callback(conf, is_master, prefix, cluster, instance, path, host, p
             ca_file_path = node.values[0]
         elif node.key == "dcos_url":
             dcos_url = node.values[0]
+        elif node.key == "dcos_token_cache_file":
+            token_cache_file = node.values[0]
+        elif node.key == "FetchConcurrency":
+            fetch_concurrency = max(1, int(node.values[0]))
+        elif node.key == "Interval":
+            read_interval = float(node.values[0])
+        elif node.key == "StreamResponses":
+            stream_responses = bool(node.values[0])
+        elif node.key == "StreamingThreshold":
+            streaming_threshold = int(node.values[0])
+        elif node.key == "TaskPageSize":
+            task_page_size = int(node.values[0])
+        elif node.key == "TaskPageParallelism":
+            task_page_parallelism = int(node.values[0])
+        elif node.key == "TaskRollup":
+            task_rollups.append(tuple(node.values))
+        elif node.key == "PerTaskMetrics":
+            per_task_metrics = bool(node.values[0])
+        elif node.key == "PerTaskAllowlist":
+            per_task_allowlist.extend(node.values)
+        elif node.key == "TaskSampleRate":
+            task_sample_rate = float(node.values[0])
+        elif node.key == "FrameworkSampleRate":
+            framework_sample_rates.append((node.values[0], float(node.values[1])))
+        elif node.key == "SuppressUnchanged":
+            suppress_unchanged = bool(node.values[0])
+        elif node.key == "HeartbeatInterval":
+            heartbeat_interval = float(node.values[0])
+        elif node.key == "SelfMetrics":
+            self_metrics = bool(node.values[0])
+        elif node.key == "MultiValueResources":
+            multi_value_resources = bool(node.values[0])
+        elif node.key == "CompressResponses":
+            compress_responses = bool(node.values[0])
+        elif node.key == "CaptureDirectory":
+            capture_directory = node.values[0]
+        elif node.key == "CaptureReads":
+            capture_reads = max(1, int(node.values[0]))
+        elif node.key == "FollowLeader":
+            follow = bool(node.values[0])
+        elif node.key == "Subscribe":
+            subscribe = bool(node.values[0])
+        elif node.key == "CollectAgents":
+            collect_agents = bool(node.values[0])
+        elif node.key == "AgentRefreshInterval":
+            agent_refresh_interval = float(node.values[0])
+        elif node.key == "AgentConcurrency":
+            agent_concurrency = max(1, int(node.values[0]))
+        elif node.key == "AgentKeepAlive":
+            agent_keep_alive = bool(node.values[0])
+        elif node.key == "AgentContainerStats":
+            agent_container_stats = bool(node.values[0])
+        elif node.key == "AgentStatsInclude":
+            agent_stats_include.extend(node.values)
+        elif node.key == "AgentStatsExclude":
+            agent_stats_exclude.extend(node.values)
+        elif node.key in INTERVAL_KEYS:
+            intervals[INTERVAL_KEYS[node.key]] = float(node.values[0])
+        elif node.key == "IntervalJitter":
+            interval_jitter = float(node.values[0])
+        elif node.key == "ConnectTimeout":
+            connect_timeout = float(node.values[0])
+        elif node.key == "ReadTimeout":
+            read_timeout = float(node.values[0])
+        elif node.key == "ReadDeadline":
+            read_deadline = float(node.values[0])
+        elif node.key == "BreakerThreshold":
+            breaker_threshold = int(node.values[0])
+        elif node.key == "BreakerBackoff":
+            breaker_backoff = float(node.values[0])
+        elif node.key == "BreakerMaxBackoff":
+            breaker_max_backoff = float(node.values[0])
         else:
             collectd.warning("%s plugin: Unknown config key: %s." % (prefix, node.key))
             continue
 
+    config = {"prefix": prefix, "is_master": is_master, "tables": tables, "verboseLogging": verboseLogging}
+
+    if multi_value_resources and not resources_type_defined():
+        collectd.warning(
+            "%s plugin: Type %s is not defined, add mesos_types.db to TypesDB to use MultiValueResources."
+            % (prefix, RESOURCES_TYPE)
+        )
+        multi_value_resources = False
+
     # Relevant only when monitoring mesos hosting DC/OS in strict mode
     dcos_auth_token = ""
     dcos_auth_header = {}
+    dcos_token = None
     if dcos_sfx_username and dcos_sfx_password and scheme == "https":
         collectd.info("Configuring Mesos plugin to operate in DC/OS strict mode.")
         dcos_url = dcos_url or "https://leader.mesos/acs/api/v1/auth/login"
-        dcos_auth_token = get_dcos_auth_token(dcos_sfx_username, dcos_sfx_password, host, dcos_url, True)
+        dcos_token = get_dcos_token(dcos_sfx_username, dcos_sfx_password, host, dcos_url, token_cache_file, config)
+        dcos_auth_token = dcos_token.get()
         dcos_auth_header = {"Authorization": ("token=%s" % (str(dcos_auth_token)))}
     try:
         if ca_file_path:
@@ -172,46 +524,73 @@ def configure_callback(conf, is_master, prefix, cluster, instance, path, host, p
         ssl_context = None
     scheme += "://"
 
-    global MESOS_VERSION
     binary = "%s/%s" % (path, "mesos-master" if is_master else "mesos-slave")
     version = None
+    mesos_version = None
     try:
         if os.path.exists(binary):
             # Expected output: mesos <version_string>
-            version = subprocess.check_output([binary, "--version"])
-            MESOS_VERSION = version.strip().split()[-1]
+            version = subprocess.check_output([binary, "--version"]).decode("utf-8")
+            mesos_version = version.strip().split()[-1]
         else:
             version_api_url = scheme + host + ":" + str(port) + "/version"
             version = get_version_from_api(
                 version_api_url,
-                {"dcos_auth_token": dcos_auth_token, "ssl_context": ssl_context, "dcos_auth_header": dcos_auth_header},
+                {
+                    "dcos_auth_token": dcos_auth_token,
+                    "ssl_context": ssl_context,
+                    "dcos_auth_header": dcos_auth_header,
+                    "connect_timeout": connect_timeout,
+                    "read_timeout": read_timeout,
+                },
             )
-            MESOS_VERSION = version.strip()
+            mesos_version = version.strip()
     except Exception as e:
         collectd.error("Mesos version not obtained (%s)." % (e))
 
     if include_system_health:
         system_health_url = "{0}{1}:1050/system/health/v1".format(scheme, host)
-        log_verbose(
-            verboseLogging, "%s plugin to include system health metrics from url %s" % (prefix, system_health_url)
-        )
+        log_verbose(config, "%s plugin to include system health metrics from url %s" % (prefix, system_health_url))
 
     log_verbose(
-        verboseLogging,
+        config,
         "%s plugin configured with host = %s, port = %s, verbose "
         "logging = %s, version = %s, instance = %s, cluster = %s, "
         "path = %s" % (prefix, host, port, verboseLogging, version, instance, cluster, path),
     )
-    CONFIGS.append(
+    config.update(
         {
             "host": host,
             "port": port,
             "mesos_url": scheme + host + ":" + str(port) + "/metrics/snapshot",
             "framework_url": (scheme + host + ":" + str(port) + "/master/frameworks"),
             "task_url": scheme + host + ":" + str(port) + "/master/tasks",
+            "slaves_url": (
+                (scheme + host + ":" + str(port) + "/master/slaves") if collect_agents and is_master else None
+            ),
+            "agent_refresh_interval": agent_refresh_interval,
+            "agent_concurrency": agent_concurrency,
+            "agent_keep_alive": agent_keep_alive,
+            "agent_container_stats": agent_container_stats,
+            "agent_stats_include": agent_stats_include,
+            "agent_stats_exclude": agent_stats_exclude,
+            "agent_stat_plans": collections.deque(),
+            "agent_container_samples": {},
+            "agents": None,
+            "monitor_url": (
+                scheme + host + ":" + str(port) + "/monitor/statistics"
+                if include_container_stats and not is_master
+                else None
+            ),
             "system_health_url": system_health_url,
+            "discover_stats": discover_stats,
+            "stats_include": stats_include,
+            "stats_exclude": stats_exclude,
+            "stat_templates": stat_templates,
             "verboseLogging": verboseLogging,
             "version": version,
+            "mesos_version": mesos_version,
+            "metric_plan": None,
             "instance": instance,
             "cluster": cluster,
             "path": path,
@@ -221,23 +600,63 @@ def configure_callback(conf, is_master, prefix, cluster, instance, path, host, p
             "dcos_auth_token": dcos_auth_token,
             "dcos_url": dcos_url,
             "dcos_auth_header": dcos_auth_header,
+            "dcos_token": dcos_token,
             "ca_file_path": ca_file_path,
             "ssl_context": ssl_context,
+            "stream_responses": stream_responses,
+            "streaming_threshold": streaming_threshold,
+            "task_page_size": task_page_size,
+            "task_page_parallelism": task_page_parallelism,
+            "task_rollups": task_rollups,
+            "per_task_metrics": per_task_metrics,
+            "per_task_allowlist": per_task_allowlist,
+            "task_sampler": (
+                TaskSampler(task_sample_rate, framework_sample_rates)
+                if task_sample_rate < 1.0 or framework_sample_rates
+                else None
+            ),
+            "follow_leader": follow and is_master,
+            "elected": None,
+            "intervals": intervals,
+            "interval_jitter": interval_jitter,
+            "next_poll": {},
+            "connect_timeout": connect_timeout,
+            "read_timeout": read_timeout,
+            "read_deadline": read_deadline,
+            "deadline_at": None,
+            "breaker_threshold": breaker_threshold,
+            "breaker_backoff": breaker_backoff,
+            "breaker_max_backoff": breaker_max_backoff,
+            "breakers": {},
+            "leader": None,
+            "emission_filter": EmissionFilter(heartbeat_interval) if suppress_unchanged else None,
+            "plugin_stats": PluginStats() if self_metrics else None,
+            "compress_responses": compress_responses,
+            "capture": Capture(capture_directory, capture_reads, prefix) if capture_directory else None,
+            "fetch_concurrency": fetch_concurrency,
+            "fetch_pool": None,
+            "multi_value_resources": multi_value_resources,
+            "entity_stats": {},
         }
     )
+    if subscribe:
+        if is_master:
+            config["subscriber"] = OperatorSubscriber(config)
+        else:
+            collectd.warning("%s plugin: Subscribe only applies to masters, ignoring it." % prefix)
+    CONFIGS.append(config)
+    if tables is not None:
+        register_instance(PluginInstance(config), read_interval)
 
 
-def get_dcos_auth_token(uid, password, host, dcos_url, verbose_log):
+def get_dcos_auth_token(uid, password, host, dcos_url, log_conf):
     try:
-        log_verbose(verbose_log, "INFO: Getting DC/OS authentication token.")
+        log_verbose(log_conf, "INFO: Getting DC/OS authentication token.")
         headers = {"Content-Type": "application/json"}
         data = json.dumps({"uid": uid, "password": password})
         if not dcos_url:
             raise KeyError("DC/OS url is not configured.")
-        try:
-            context = ssl._create_unverified_context()
-        except AttributeError:
-            context = None
+        context = get_login_ssl_context()
         conf = {"dcos_sfx_username": uid, "dcos_sfx_password": password, "host": host, "dcos_url": dcos_url}
         response = get_json(dcos_url, conf, context, headers, data)
         return response["token"]
@@ -247,39 +666,801 @@ def get_dcos_auth_token(uid, password, host, dcos_url, verbose_log):
         collectd.error("ERROR: Getting DC/OS authentication token failed: (%s)." % (e))
 
 
+LOGIN_SSL_CONTEXT = []
+
+
+def get_login_ssl_context():
+    """Returns the shared unverified context used for DC/OS logins, so that
+    pooled connections to the login URL can be reused."""
+    if not LOGIN_SSL_CONTEXT:
+        try:
+            LOGIN_SSL_CONTEXT.append(ssl._create_unverified_context())
+        except AttributeError:
+            LOGIN_SSL_CONTEXT.append(None)
+    return LOGIN_SSL_CONTEXT[0]
+
+
+# Tokens are refreshed in the background once less than this many seconds
+# of their lifetime remain
+DCOS_TOKEN_REFRESH_MARGIN = 600
+# Seconds before logging in again after a failed login, doubled per failure
+DCOS_LOGIN_BACKOFF = 5.0
+DCOS_LOGIN_MAX_BACKOFF = 300.0
+DCOS_TOKEN_CACHE_FILE = os.path.join(tempfile.gettempdir(), "collectd-mesos-dcos-token-%d.json" % os.getuid())
+DCOS_TOKENS = {}
+DCOS_TOKENS_LOCK = threading.Lock()
+
+
+def decode_token_expiry(token):
+    """Returns the exp claim of a JWT, or None if it can't be decoded"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class DCOSToken(object):
+    """DC/OS authentication token shared by all configs logging in with the
+    same account. The token is refreshed in the background before it
+    expires, concurrent callers share a single login, and the token is kept
+    in a file readable only by its owner so that restarts and other plugin
+    instances can reuse it. Messages are logged for the config that created
+    it."""
+
+    def __init__(self, uid, password, host, dcos_url, cache_file, log_conf):
+        self.uid = uid
+        self.password = password
+        self.host = host
+        self.dcos_url = dcos_url
+        self.cache_file = cache_file
+        self.cache_key = "%s@%s" % (uid, dcos_url)
+        self.log_conf = log_conf
+        self.token = None
+        self.expires_at = None
+        self.lock = threading.Lock()
+        self.refreshed = threading.Condition(self.lock)
+        self.refreshing = False
+        # Count of finished logins, so waiters can tell theirs has ended
+        self.logins = 0
+        self.backoff = DCOS_LOGIN_BACKOFF
+        self.retry_at = None
+        self.load()
+
+    def get(self):
+        """Returns a current token, logging in first if there is none"""
+        with self.lock:
+            token = self.token
+            expires_at = self.expires_at
+        if token is None or (expires_at is not None and expires_at <= time.time()):
+            return self.refresh(token)
+        if expires_at is not None and expires_at - time.time() < DCOS_TOKEN_REFRESH_MARGIN:
+            self.refresh_in_background(token)
+        return token
+
+    def refresh_in_background(self, stale):
+        with self.lock:
+            if self.refreshing or self.token != stale:
+                return
+            if self.retry_at is not None and time.monotonic() < self.retry_at:
+                return
+        thread = threading.Thread(target=self.refresh, args=(stale,), name="mesos-dcos-token")
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, stale):
+        """Replaces the stale token. Callers arriving while a login is in
+        flight take its outcome, failed or not, instead of logging in again,
+        and after a failed login no other is tried until the backoff ends."""
+        with self.lock:
+            if self.refreshing:
+                logins = self.logins
+                while self.logins == logins:
+                    self.refreshed.wait()
+                return self.token
+            if self.token is not None and self.token != stale:
+                return self.token
+            if self.retry_at is not None and time.monotonic() < self.retry_at:
+                return self.token
+            self.refreshing = True
+        token = None
+        try:
+            token = get_dcos_auth_token(self.uid, self.password, self.host, self.dcos_url, self.log_conf)
+        finally:
+            with self.lock:
+                if token:
+                    self.token = token
+                    self.expires_at = decode_token_expiry(token)
+                    self.backoff = DCOS_LOGIN_BACKOFF
+                    self.retry_at = None
+                else:
+                    self.retry_at = time.monotonic() + self.backoff
+                    self.backoff = min(DCOS_LOGIN_MAX_BACKOFF, self.backoff * 2)
+                self.refreshing = False
+                self.logins += 1
+                self.refreshed.notify_all()
+        if token:
+            self.store()
+        return self.token
+
+    def load(self):
+        if not self.cache_file:
+            return
+        try:
+            fd = os.open(self.cache_file, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        except OSError:
+            return
+        try:
+            info = os.fstat(fd)
+            if info.st_uid != os.getuid() or info.st_mode & 0o077:
+                collectd.warning(
+                    "%s plugin: Ignoring DC/OS token cache %s with unsafe ownership or permissions."
+                    % (self.log_conf["prefix"], self.cache_file)
+                )
+                return
+            with os.fdopen(fd, "r") as cache:
+                fd = None
+                entry = json.load(cache).get(self.cache_key)
+        except (OSError, ValueError, AttributeError):
+            return
+        finally:
+            if fd is not None:
+                os.close(fd)
+        if not entry:
+            return
+        expires_at = decode_token_expiry(entry)
+        if expires_at is not None and expires_at > time.time():
+            self.token = entry
+            self.expires_at = expires_at
+            log_verbose(self.log_conf, "INFO: Using cached DC/OS authentication token.")
+
+    def store(self):
+        """Writes the token to the cache file, keeping tokens of other
+        accounts, through an owner-only temporary file renamed into place."""
+        if not self.cache_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        entries = {}
+        try:
+            with open(self.cache_file) as cache:
+                entries = json.load(cache)
+        except (OSError, ValueError):
+            pass
+        entries[self.cache_key] = self.token
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".mesos-dcos-token-")
+            with os.fdopen(fd, "w") as tmp:
+                json.dump(entries, tmp)
+            os.rename(tmp_path, self.cache_file)
+        except OSError as e:
+            collectd.warning(
+                "%s plugin: Failed to cache DC/OS token in %s (%s)." % (self.log_conf["prefix"], self.cache_file, e)
+            )
+
+
+def get_dcos_token(uid, password, host, dcos_url, cache_file, log_conf):
+    """Returns the shared DCOSToken for an account"""
+    with DCOS_TOKENS_LOCK:
+        key = (uid, dcos_url)
+        token = DCOS_TOKENS.get(key)
+        if token is None:
+            token = DCOS_TOKENS[key] = DCOSToken(uid, password, host, dcos_url, cache_file, log_conf)
+        return token
+
+
+def get_auth_header(conf):
+    """Returns the request headers carrying the current DC/OS token"""
+    dcos_token = conf.get("dcos_token")
+    if dcos_token is None:
+        return conf.get("dcos_auth_header", {})
+    token = dcos_token.get()
+    if token != conf["dcos_auth_token"]:
+        conf["dcos_auth_token"] = token
+        conf["dcos_auth_header"] = {"Authorization": ("token=%s" % (str(token)))}
+    return conf["dcos_auth_header"]
+
+
 def get_version_from_api(url, conf):
-    result = get_json(url, conf, conf["ssl_context"], headers=conf["dcos_auth_header"])
+    result = get_json(url, conf, conf["ssl_context"], headers=get_auth_header(conf))
     if result:
         return result["version"]
 
 
-def fetch_stats(conf):
-    result = get_json(conf["mesos_url"], conf, conf["ssl_context"], headers=conf["dcos_auth_header"])
-    if result:
-        parse_stats(conf, result)
+def fetch_endpoint(conf, url):
+    """Fetches and decodes the JSON body of one endpoint"""
+    return get_json(url, conf, conf["ssl_context"], headers=get_auth_header(conf))
 
 
-def fetch_framework_stats(conf):
-    result = get_json(conf["framework_url"], conf, conf["ssl_context"], headers=conf["dcos_auth_header"])
-    if result:
-        parse_framework_stats(conf, result)
+def fetch_frameworks(conf, url):
+    index = subscribed_index(conf)
+    if index is not None:
+        return index.framework_list()
+    return get_json_stream(url, conf, conf["ssl_context"], "frameworks", headers=get_auth_header(conf))
 
 
-def fetch_task_stats(conf):
-    result = get_json(conf["task_url"], conf, conf["ssl_context"], headers=conf["dcos_auth_header"])
-    if result:
-        parse_task_stats(conf, result)
+def fetch_tasks(conf, url):
+    index = subscribed_index(conf)
+    if index is not None:
+        return index.task_list()
+    if conf.get("task_page_size", 0) <= 0:
+        return get_json_stream(url, conf, conf["ssl_context"], "tasks", headers=get_auth_header(conf))
+    first_page = fetch_task_page(conf, url, 0)
+    if first_page is None:
+        return None
+    return {"tasks": TaskPages(conf, url, first_page)}
+
+
+def fetch_task_page(conf, url, offset):
+    page_url = "%s?limit=%d&offset=%d&order=asc" % (url, conf["task_page_size"], offset)
+    return get_json_stream(page_url, conf, conf["ssl_context"], "tasks", headers=get_auth_header(conf))
+
+
+class TaskPages(object):
+    """Iterates the tasks of /master/tasks page by page using limit and
+    offset. Up to task_page_parallelism further pages are requested ahead
+    while the current one is processed; a short page ends the listing. A
+    page that fails or the read deadline leaves the listing incomplete."""
+
+    def __init__(self, conf, url, first_page):
+        self.conf = conf
+        self.url = url
+        self.page_size = conf["task_page_size"]
+        self.parallelism = max(1, conf.get("task_page_parallelism", 1))
+        self.current = first_page
+        self.pending = collections.deque()
+        self.pages = 0
+        self.complete = True
+
+    def request_ahead(self, offset):
+        while len(self.pending) < self.parallelism:
+            self.pending.append(submit_fetch(self.conf, fetch_task_page, self.conf, self.url, offset))
+            offset += self.page_size
+        return offset
+
+    def __iter__(self):
+        next_offset = self.page_size
+        try:
+            while True:
+                tasks = self.current.get("tasks", ())
+                count = 0
+                for task in tasks:
+                    count += 1
+                    yield task
+                if not getattr(tasks, "complete", True):
+                    self.incomplete(self.pages * self.page_size)
+                    break
+                self.pages += 1
+                if count < self.page_size:
+                    break
+                if past_deadline(self.conf):
+                    collectd.warning(
+                        "%s plugin: Read deadline reached after %d pages of %s."
+                        % (self.conf["prefix"], self.pages, self.url)
+                    )
+                    self.complete = False
+                    break
+                next_offset = self.request_ahead(next_offset)
+                self.current = self.pending.popleft().result()
+                if not self.current:
+                    self.incomplete(self.pages * self.page_size)
+                    break
+        finally:
+            self.close()
+
+    def incomplete(self, offset):
+        collectd.warning(
+            "%s plugin: Fetching the tasks at offset %d of %s failed, the task list is incomplete."
+            % (self.conf["prefix"], offset, self.url)
+        )
+        self.complete = False
+
+    def close(self):
+        close_streams(self.current)
+        self.current = None
+        while self.pending:
+            future = self.pending.popleft()
+            if future.exception() is None:
+                close_streams(future.result())
+
+
+# Seconds between attempts to re-establish an Operator API subscription
+SUBSCRIBE_BACKOFF = 1.0
+SUBSCRIBE_MAX_BACKOFF = 60.0
+# A subscription is considered dead after this many missed heartbeats
+SUBSCRIBE_MISSED_HEARTBEATS = 3
+SUBSCRIBE_HEARTBEAT_INTERVAL = 15.0
+# Terminal tasks kept per framework, as the master does by default
+MAX_COMPLETED_TASKS = 1000
+TERMINAL_TASK_STATES = frozenset(
+    (
+        "TASK_FINISHED",
+        "TASK_FAILED",
+        "TASK_KILLED",
+        "TASK_ERROR",
+        "TASK_LOST",
+        "TASK_DROPPED",
+        "TASK_GONE",
+        "TASK_GONE_BY_OPERATOR",
+    )
+)
+FRAMEWORK_RESOURCES = ("cpus", "mem", "disk", "gpus")
+
+
+def v1_value(obj, key):
+    """Returns the value of a v1 API identifier field such as task_id"""
+    return (obj.get(key) or {}).get("value")
+
+
+def convert_v1_resources(resources):
+    """Sums v1 API resources into the name to value mapping of the v0 API"""
+    totals = {}
+    for resource in resources or ():
+        name = resource.get("name")
+        if "scalar" in resource:
+            totals[name] = totals.get(name, 0.0) + resource["scalar"].get("value", 0.0)
+        elif "ranges" in resource:
+            ranges = ["%s-%s" % (r.get("begin"), r.get("end")) for r in resource["ranges"].get("range", ())]
+            totals[name] = "[%s]" % ", ".join(ranges)
+    return totals
+
+
+class IndexedTask(object):
+    """A task of an OperatorIndex. It reads like a /master/tasks entry but
+    only holds the fields the task tables use, not the status history, with
+    the strings repeated across tasks interned and resources shared between
+    tasks that have the same ones. Tasks are immutable, replace() returns
+    an updated copy."""
+
+    __slots__ = ("id", "name", "framework_id", "executor_id", "slave_id", "state", "resources", "container")
+    FIELDS = frozenset(__slots__)
+
+    def __init__(self, id, name, framework_id, executor_id, slave_id, state, resources, container):
+        self.id = id
+        self.name = name
+        self.framework_id = framework_id
+        self.executor_id = executor_id
+        self.slave_id = slave_id
+        self.state = state
+        self.resources = resources
+        self.container = container
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def replace(self, **changes):
+        fields = dict((name, getattr(self, name)) for name in self.__slots__)
+        fields.update(changes)
+        return IndexedTask(**fields)
+
+
+def intern_optional(value):
+    return sys.intern(value) if value.__class__ is str else value
+
+
+def convert_v1_task(task, shared_resources=None):
+    """Returns a v1 API task as an IndexedTask. Resources equal to an entry
+    of shared_resources are replaced by that entry."""
+    resources = convert_v1_resources(task.get("resources"))
+    if shared_resources is not None:
+        resources = shared_resources.setdefault(tuple(sorted(resources.items())), resources)
+    return IndexedTask(
+        v1_value(task, "task_id"),
+        intern_optional(task.get("name")),
+        intern_optional(v1_value(task, "framework_id")),
+        intern_optional(v1_value(task, "executor_id") or ""),
+        intern_optional(v1_value(task, "agent_id")),
+        intern_optional(task.get("state")),
+        resources,
+        task.get("container", {}),
+    )
+
+
+def convert_v1_framework(framework):
+    """Returns a v1 API framework in the shape of a /master/frameworks entry,
+    without the resources which are derived from the tasks"""
+    info = framework.get("framework_info", {})
+    return {
+        "id": v1_value(info, "id"),
+        "name": info.get("name"),
+        "user": info.get("user"),
+        "hostname": info.get("hostname"),
+        "role": info.get("role"),
+        "active": framework.get("active", True),
+    }
+
+
+class OperatorIndex(object):
+    """Tasks, frameworks and agents of a master kept current from the events
+    of a v1 Operator API subscription. Tasks and frameworks are stored in the
+    shape of the /master/tasks and /master/frameworks responses and are
+    replaced rather than modified, so lists handed out stay consistent."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Task ids are only unique within a framework, tasks are keyed by
+        # (framework_id, task_id)
+        self.tasks = {}
+        self.frameworks = {}
+        self.agents = {}
+        # Keys of terminal tasks per framework, oldest first
+        self.completed = collections.defaultdict(collections.deque)
+        # Distinct task resources, shared by the tasks that have them
+        self.resources = {}
+
+    def apply(self, event):
+        kind = event.get("type")
+        with self.lock:
+            if kind == "SUBSCRIBED":
+                self.load(event["subscribed"].get("get_state", {}))
+            elif kind == "TASK_ADDED":
+                self.put_task(convert_v1_task(event["task_added"]["task"], self.resources))
+            elif kind == "TASK_UPDATED":
+                self.update_task(event["task_updated"])
+            elif kind in ("FRAMEWORK_ADDED", "FRAMEWORK_UPDATED"):
+                framework = convert_v1_framework(event[kind.lower()]["framework"])
+                self.frameworks[framework["id"]] = framework
+            elif kind == "FRAMEWORK_REMOVED":
+                self.remove_framework(v1_value(event["framework_removed"]["framework_info"], "id"))
+            elif kind == "AGENT_ADDED":
+                info = event["agent_added"]["agent"].get("agent_info", {})
+                self.agents[v1_value(info, "id")] = info.get("hostname")
+            elif kind == "AGENT_REMOVED":
+                self.agents.pop(v1_value(event["agent_removed"], "agent_id"), None)
+
+    def load(self, state):
+        """Replaces the index with the get_state of a SUBSCRIBED event"""
+        self.tasks = {}
+        self.completed.clear()
+        self.resources = {}
+        get_tasks = state.get("get_tasks", {})
+        for kind in ("completed_tasks", "unreachable_tasks", "tasks"):
+            for task in get_tasks.get(kind, ()):
+                self.put_task(convert_v1_task(task, self.resources))
+        self.frameworks = {}
+        for framework in state.get("get_frameworks", {}).get("frameworks", ()):
+            framework = convert_v1_framework(framework)
+            self.frameworks[framework["id"]] = framework
+        self.agents = {}
+        for agent in state.get("get_agents", {}).get("agents", ()):
+            info = agent.get("agent_info", {})
+            self.agents[v1_value(info, "id")] = info.get("hostname")
+
+    def put_task(self, task):
+        key = (task.framework_id, task.id)
+        self.tasks[key] = task
+        if task.state in TERMINAL_TASK_STATES:
+            completed = self.completed[task.framework_id]
+            if key not in completed:
+                completed.append(key)
+                if len(completed) > MAX_COMPLETED_TASKS:
+                    self.tasks.pop(completed.popleft(), None)
+
+    def update_task(self, update):
+        status = update.get("status", {})
+        task = self.tasks.get((v1_value(update, "framework_id"), v1_value(status, "task_id")))
+        if task is None:
+            return
+        self.put_task(task.replace(state=intern_optional(update.get("state") or status.get("state"))))
+
+    def remove_framework(self, framework_id):
+        self.frameworks.pop(framework_id, None)
+        self.completed.pop(framework_id, None)
+        self.tasks = {key: task for key, task in self.tasks.items() if task.framework_id != framework_id}
+
+    def task_list(self):
+        with self.lock:
+            return {"tasks": list(self.tasks.values())}
+
+    def framework_list(self):
+        """Returns the frameworks with the resources of their active tasks as
+        used_resources"""
+        with self.lock:
+            tasks = list(self.tasks.values())
+            frameworks = list(self.frameworks.values())
+        used = {}
+        for task in tasks:
+            if task.state in TERMINAL_TASK_STATES:
+                continue
+            totals = used.setdefault(task.framework_id, dict.fromkeys(FRAMEWORK_RESOURCES, 0.0))
+            for name in FRAMEWORK_RESOURCES:
+                value = task.resources.get(name)
+                if value is not None:
+                    totals[name] += value
+        result = []
+        for framework in frameworks:
+            framework = dict(framework)
+            framework["used_resources"] = used.get(framework["id"], dict.fromkeys(FRAMEWORK_RESOURCES, 0.0))
+            result.append(framework)
+        return {"frameworks": result}
+
+
+def read_recordio(fp):
+    """Yields the JSON records of a RecordIO stream, in which every record
+    is preceded by its length in bytes and a newline"""
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+        line = line.strip()
+        if not line:
+            continue
+        length = int(line)
+        data = fp.read(length)
+        if len(data) < length:
+            raise EOFError("RecordIO stream ended within a record")
+        yield json.loads(data)
+
+
+class OperatorSubscriber(object):
+    """Keeps an OperatorIndex current through a SUBSCRIBE call to the v1
+    Operator API of the master a config collects from. A daemon thread holds
+    the connection and, after a disconnect or a change of leader, reconnects
+    with backoff and resyncs from the snapshot in the SUBSCRIBED event."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.index = OperatorIndex()
+        self.synced = False
+        self.netloc = None
+        self.sock = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def current(self):
+        """Returns the index if it is in sync with the master the config
+        collects from, else None, starting or moving the subscription"""
+        netloc = urllib.parse.urlsplit(self.conf["mesos_url"]).netloc
+        with self.lock:
+            if self.thread is None:
+                self.netloc = netloc
+                self.thread = threading.Thread(target=self.run, name="mesos-subscriber", daemon=True)
+                self.thread.start()
+                return None
+            if self.netloc != netloc:
+                log_verbose(self.conf, "Moving the subscription to %s." % netloc)
+                self.netloc = netloc
+                self.synced = False
+                self.disconnect()
+                return None
+            return self.index if self.synced else None
+
+    def run(self):
+        backoff = SUBSCRIBE_BACKOFF
+        while not self.stopped.is_set():
+            try:
+                if self.subscribe():
+                    backoff = SUBSCRIBE_BACKOFF
+            except Exception as e:
+                if not self.stopped.is_set():
+                    collectd.warning(
+                        "%s plugin: Operator API subscription to %s failed: %s" % (self.conf["prefix"], self.netloc, e)
+                    )
+            with self.lock:
+                self.synced = False
+                self.sock = None
+            if self.stopped.wait(backoff):
+                break
+            backoff = min(SUBSCRIBE_MAX_BACKOFF, backoff * 2)
+
+    def subscribe(self):
+        """Follows one subscription until it ends, returns whether it got in
+        sync"""
+        conf = self.conf
+        with self.lock:
+            netloc = self.netloc
+        if urllib.parse.urlsplit(conf["mesos_url"]).scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=conf["connect_timeout"], context=conf["ssl_context"])
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=conf["connect_timeout"])
+        try:
+            conn.connect()
+            with self.lock:
+                if self.netloc != netloc or self.stopped.is_set():
+                    return False
+                self.sock = sock = conn.sock
+            headers = {"Content-Type": "application/json", "Accept": "application/json"}
+            headers.update(get_auth_header(conf))
+            conn.request("POST", "/api/v1", body=json.dumps({"type": "SUBSCRIBE"}), headers=headers)
+            sock.settimeout(SUBSCRIBE_HEARTBEAT_INTERVAL * SUBSCRIBE_MISSED_HEARTBEATS)
+            response = conn.getresponse()
+            if response.status != 200:
+                if response.status == 401 and conf.get("dcos_token"):
+                    refresh_dcos_auth_token(conf)
+                raise urllib.error.HTTPError(
+                    "/api/v1", response.status, response.reason, response.headers, io.BytesIO(response.read())
+                )
+            synced = False
+            for event in read_recordio(response):
+                self.index.apply(event)
+                if event.get("type") == "SUBSCRIBED":
+                    interval = event["subscribed"].get("heartbeat_interval_seconds") or SUBSCRIBE_HEARTBEAT_INTERVAL
+                    sock.settimeout(interval * SUBSCRIBE_MISSED_HEARTBEATS)
+                    with self.lock:
+                        self.synced = self.netloc == netloc
+                    synced = True
+                    log_verbose(
+                        conf,
+                        "Subscribed to %s with %d tasks." % (netloc, len(self.index.tasks)),
+                    )
+            return synced
+        finally:
+            conn.close()
+
+    def disconnect(self):
+        """Ends the current subscription, called with the lock held"""
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            self.disconnect()
+
+
+def subscribed_index(conf):
+    """Returns the Operator API index of a config if it is in sync"""
+    subscriber = conf.get("subscriber")
+    if subscriber is None:
+        return None
+    return subscriber.current()
+
 
+# Collection from every agent by a master plugin with CollectAgents set
+AGENT_PORT = 5051
+AGENT_CONCURRENCY = 32
+AGENT_REFRESH_INTERVAL = 300.0
+# Snapshot key sets remembered per config, agents of one version share one
+AGENT_STAT_PLANS = 8
 
-def fetch_system_health(conf):
-    """Fetch system health metrics"""
-    system_health_url = conf["system_health_url"]
-    if IS_MASTER and system_health_url:
-        result = get_json(system_health_url, conf, conf["ssl_context"], headers=conf["dcos_auth_header"])
-        if result:
-            for unit in result["units"]:
-                dims = ",system_component=%s,system_component_name=%s" % (unit["id"], unit["name"])
-                dispatch_system_health(unit["health"], "mesos.service.health", "gauge", conf, dims)
+Agent = collections.namedtuple("Agent", ("id", "hostname", "url"))
+
+
+def parse_agent_list(conf, slaves):
+    """Returns the active agents of a /master/slaves response, addressed by
+    the host:port of their pid"""
+    agents = []
+    for slave in slaves:
+        if not slave.get("active", True):
+            continue
+        pid = slave.get("pid") or ""
+        netloc = pid.rsplit("@", 1)[1] if "@" in pid else None
+        if not netloc:
+            netloc = "%s:%s" % (slave.get("hostname"), slave.get("port", AGENT_PORT))
+        agents.append(Agent(slave.get("id"), slave.get("hostname"), conf["scheme"] + netloc))
+    return agents
+
+
+def get_agents(conf):
+    """Returns the agents of the cluster, listed again from /master/slaves
+    every agent_refresh_interval seconds. The previous list is kept while
+    listing fails."""
+    now = time.monotonic()
+    if conf.get("agents") is None or now >= conf["agents_refresh_at"]:
+        result = get_json_stream(conf["slaves_url"], conf, conf["ssl_context"], "slaves", headers=get_auth_header(conf))
+        if result is not None:
+            try:
+                agents = parse_agent_list(conf, result.get("slaves", ()))
+            finally:
+                close_streams(result)
+            conf["agents"] = agents
+            conf["agents_refresh_at"] = now + conf["agent_refresh_interval"]
+            listed = set(agent.id for agent in agents)
+            samples = conf["agent_container_samples"]
+            for agent_id in [agent_id for agent_id in samples if agent_id not in listed]:
+                del samples[agent_id]
+            log_verbose(conf, "Collecting from %d agents." % len(agents))
+    return conf.get("agents") or []
+
+
+def get_agent_pool(conf):
+    pool = conf.get("agent_pool")
+    if pool is None:
+        pool = conf["agent_pool"] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=conf["agent_concurrency"], thread_name_prefix="mesos-agent"
+        )
+    return pool
+
+
+def fetch_agent(conf, agent, headers):
+    """Fetches the snapshot of an agent and, if enabled, its container
+    statistics"""
+    snapshot = get_json(agent.url + "/metrics/snapshot", conf, conf["ssl_context"], headers=headers)
+    statistics = None
+    if snapshot is not None and conf["agent_container_stats"]:
+        statistics = get_json(agent.url + "/monitor/statistics", conf, conf["ssl_context"], headers=headers)
+    return agent, snapshot, statistics
+
+
+def fetch_agents(conf, url):
+    """Polls all agents of the cluster, at most agent_concurrency at a time,
+    and returns (agent, snapshot, statistics) for each agent that answered
+    before the read deadline"""
+    agents = get_agents(conf)
+    headers = dict(get_auth_header(conf))
+    if not conf["agent_keep_alive"]:
+        # Thousands of idle keep-alive connections cost more than reconnecting
+        headers["Connection"] = "close"
+    pool = get_agent_pool(conf)
+    futures = [pool.submit(fetch_agent, conf, agent, headers) for agent in agents]
+    results = []
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=time_left(conf)):
+            try:
+                agent, snapshot, statistics = future.result()
+            except Exception as e:
+                log_verbose(conf, "Polling an agent failed: %s" % e)
+                continue
+            if snapshot is not None:
+                results.append((agent, snapshot, statistics))
+    except concurrent.futures.TimeoutError:
+        collectd.warning(
+            "%s plugin: Read deadline reached after polling %d of %d agents."
+            % (conf["prefix"], len(results), len(agents))
+        )
+        for future in futures:
+            future.cancel()
+    return results
+
+
+def get_agent_stats(conf, snapshot):
+    """Returns (name, Stat) of the numeric keys of an agent snapshot that
+    pass the agent include and exclude patterns, with inferred types. Plans
+    are cached against the key sets of the snapshots."""
+    plans = conf["agent_stat_plans"]
+    for keys, stats in plans:
+        if snapshot.keys() == keys:
+            return stats
+    include = compile_patterns(conf.get("agent_stats_include"))
+    exclude = compile_patterns(conf.get("agent_stats_exclude"))
+    stats = []
+    for key, value in snapshot.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if (include is not None and not include(key)) or (exclude is not None and exclude(key)):
+            continue
+        stats.append((key, Stat(infer_stat_type(key), key)))
+    stats = tuple(stats)
+    plans.appendleft((frozenset(snapshot), stats))
+    if len(plans) > AGENT_STAT_PLANS:
+        plans.pop()
+    return stats
+
+
+def parse_agents(conf, results):
+    """Dispatches what was polled from the agents with mesos_agent and
+    mesos_agent_hostname dimensions"""
+    plan = get_metric_plan(conf)
+    for agent, snapshot, statistics in results:
+        dimensions = {"mesos_agent": agent.id, "mesos_agent_hostname": agent.hostname, "plugin_type": "slave"}
+        plugin_instance = get_plugin_instance(conf, dimensions)
+        for name, key in get_agent_stats(conf, snapshot):
+            dispatch_stat(snapshot.get(name), name, key, conf, plugin_instance=plugin_instance)
+        if statistics is not None and plan.containers:
+            samples = conf["agent_container_samples"].get(agent.id)
+            if samples is None:
+                samples = conf["agent_container_samples"][agent.id] = ContainerSamples(len(plan.container_rates))
+            dispatch_container_stats(conf, statistics, samples, dimensions)
+    return len(results)
+
+
+def parse_system_health(conf, json):
+    """Parse system health metrics"""
+    for unit in json["units"]:
+        dims = ",system_component=%s,system_component_name=%s" % (unit["id"], unit["name"])
+        dispatch_system_health(unit["health"], "mesos.service.health", "gauge", conf, dims)
+    return len(json["units"])
 
 
 def get_json(url, conf, context, headers={}, data=""):
@@ -287,34 +1468,587 @@ def get_json(url, conf, context, headers={}, data=""):
     Makes the API call and prepares the json to be returned
     """
     response = make_api_call(url, conf, context, headers, data)
+    if not response:
+        return None
     try:
-        if response:
-            return json.load(response)
-    except ValueError as e:
+        return json.load(response)
+    except (ValueError, zlib.error) as e:
         collectd.error("ERROR: JSON parsing failed: (%s) %s" % (e, url))
+        record_request_error(conf, url, e)
+    finally:
+        response.close()
 
 
-def make_api_call(url, conf, context, headers, data):
-    try:
-        req = urllib.request.Request(url, headers=headers, data=data.encode("utf-8"))
-        if context:
-            response = urllib.request.urlopen(req, context=context)
+# Default socket timeouts in seconds
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+
+
+class PooledHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection that connects within its timeout and then waits up to
+    read_timeout on each socket operation."""
+
+    read_timeout = READ_TIMEOUT
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection that resumes the last TLS session seen for its host"""
+
+    read_timeout = READ_TIMEOUT
+
+    def __init__(self, host, port=None, context=None, sessions=None, session_key=None):
+        http.client.HTTPSConnection.__init__(self, host, port, context=context)
+        self.sessions = sessions if sessions is not None else {}
+        self.session_key = session_key
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        session = self.sessions.get(self.session_key)
+        try:
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+        except ValueError:
+            # The cached session belongs to a different context
+            self.sessions.pop(self.session_key, None)
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+        self.sock.settimeout(self.read_timeout)
+
+
+# Content encodings requested with Accept-Encoding and decoded while reading
+ACCEPT_ENCODING = "gzip, deflate"
+DECODED_ENCODINGS = frozenset(("gzip", "x-gzip", "deflate"))
+
+
+class PooledResponse(object):
+    """File-like wrapper that hands the connection back to its pool once the
+    response body has been consumed."""
+
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.decoder = None
+        encoding = (response.headers.get("Content-Encoding") or "").strip().lower()
+        if encoding in DECODED_ENCODINGS:
+            # Accepts gzip and zlib wrapped deflate streams
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        # Deflate bodies may also come without the zlib wrapper
+        self.raw_deflate = encoding == "deflate"
+        # Body bytes received and after decompression
+        self.received = 0
+        self.decoded = 0
+        # Called with the received and decoded byte counts once the body is done
+        self.on_done = None
+        # CapturedResponse the decoded body is copied to as it is read
+        self.capture = None
+
+    @property
+    def length(self):
+        """Length of the decoded body if known in advance, else None"""
+        length = self.headers.get("Content-Length")
+        if length is None or self.decoder is not None:
+            return None
+        return int(length)
+
+    def read(self, amt=None):
+        if self.decoder is None:
+            data = self.response.read(amt)
+            self.received += len(data)
         else:
-            response = urllib.request.urlopen(req)
+            data = self.decompress(amt)
+        self.decoded += len(data)
+        if self.capture is not None:
+            self.capture.write(data)
+        if self.response.isclosed():
+            self.release()
+            # Compressed bodies may still have output pending in the decoder
+            if self.decoder is None or not data:
+                self.done()
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def decompress(self, amt):
+        """Returns up to amt bytes of the decoded body, or the rest of it
+        without amt, reading only as much of the raw body as needed"""
+        if amt is None:
+            raw = self.response.read()
+            self.received += len(raw)
+            return self.inflate(self.decoder.unconsumed_tail + raw) + self.decoder.flush()
+        while True:
+            raw = self.decoder.unconsumed_tail
+            if not raw:
+                raw = self.response.read(amt)
+                self.received += len(raw)
+                if not raw:
+                    return self.decoder.flush()
+            data = self.inflate(raw, amt)
+            if data:
+                return data
+
+    def inflate(self, raw, amt=0):
+        """Decompresses raw body bytes, switching to raw deflate when a
+        deflate body turns out to lack the zlib header"""
+        try:
+            return self.decoder.decompress(raw, amt)
+        except zlib.error:
+            if not self.raw_deflate or self.decoded:
+                raise
+            self.raw_deflate = False
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decoder.decompress(raw, amt)
+
+    def done(self):
+        if self.on_done is not None:
+            on_done, self.on_done = self.on_done, None
+            on_done(self.received, self.decoded)
+        if self.capture is not None:
+            capture, self.capture = self.capture, None
+            capture.finish(self.decoded)
+
+    def release(self):
+        if self.conn is not None:
+            self.pool.release(self.key, self.conn)
+            self.conn = None
+
+    def close(self):
+        self.done()
+        if self.conn is not None:
+            if self.response.isclosed():
+                self.release()
+            else:
+                # An unread body leaves the connection unusable
+                self.response.close()
+                self.conn.close()
+                self.conn = None
+
+
+class ConnectionPool(object):
+    """Keeps idle HTTP/1.1 keep-alive connections per host and TLS context,
+    and the last TLS session per host for resumption on reconnect."""
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.sessions = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.stale = collections.Counter()
+
+    def acquire(self, key, context):
+        """Returns an idle connection for key, or a new one, and whether it
+        was reused."""
+        scheme, netloc, _ = key
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                self.hits[netloc] += 1
+                return idle.pop(), True
+            self.misses[netloc] += 1
+        if scheme == "https":
+            if context is None:
+                context = ssl.create_default_context()
+            conn = ResumingHTTPSConnection(netloc, context=context, sessions=self.sessions, session_key=key)
+        else:
+            conn = PooledHTTPConnection(netloc)
+        return conn, False
+
+    def release(self, key, conn):
+        # The connection was closed after a "Connection: close" response
+        if conn.sock is None:
+            return
+        session = getattr(conn.sock, "session", None)
+        with self.lock:
+            if session is not None:
+                self.sessions[key] = session
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, headers, data, context, timeouts=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        """Sends a request over a pooled connection, retrying once on a fresh
+        connection if a reused one turns out to be stale. timeouts holds the
+        connect and read timeouts in seconds."""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc, id(context))
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        body = data.encode("utf-8") if data else None
+        method = "POST" if body else "GET"
+        while True:
+            conn, reused = self.acquire(key, context)
+            conn.timeout, conn.read_timeout = timeouts
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.read_timeout)
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused:
+                    with self.lock:
+                        self.stale[parts.netloc] += 1
+                    continue
+                raise urllib.error.URLError(e)
+            return PooledResponse(self, key, conn, response)
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+HTTP_POOL = ConnectionPool()
+
+
+def get_json_stream(url, conf, context, key, headers={}):
+    """
+    Makes the API call and returns a dictionary whose key entry streams the
+    elements of that top-level array. Responses no larger than the streaming
+    threshold are decoded in one go as by get_json.
+    """
+    response = make_api_call(url, conf, context, headers, "")
+    if not response:
+        return None
+    threshold = conf.get("streaming_threshold", STREAMING_THRESHOLD)
+    stream = conf.get("stream_responses", True)
+    length = response.length
+    head = None
+    if stream and length is None:
+        # Compressed and chunked bodies are decoded up to the threshold to
+        # learn whether they fit, and only streamed when they do not
+        try:
+            head = read_decoded(response, threshold + 1)
+        except zlib.error as e:
+            collectd.error("ERROR: JSON parsing failed: (%s) %s" % (e, url))
+            response.close()
+            return None
+        length = len(head) if len(head) <= threshold else None
+    if not stream or (length is not None and length <= threshold):
+        try:
+            return json.load(response) if head is None else json.loads(head)
+        except (ValueError, zlib.error) as e:
+            collectd.error("ERROR: JSON parsing failed: (%s) %s" % (e, url))
+        finally:
+            response.close()
+        return None
+    return {key: JSONArrayStream(response, key, url, head or b"")}
+
+
+def read_decoded(response, size):
+    """Reads decoded body bytes until size of them or the end of the body"""
+    chunks = []
+    while size > 0:
+        chunk = response.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def close_streams(result):
+    """Releases the responses behind any streamed arrays in a result"""
+    if isinstance(result, dict):
+        for value in result.values():
+            if isinstance(value, (JSONArrayStream, TaskPages)):
+                value.close()
+
+
+# Responses up to this many bytes are decoded whole rather than streamed
+STREAMING_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class JSONStreamReader(object):
+    """Incremental JSON scanner over a file-like object. Values are decoded
+    one at a time from a buffer that only holds the unread part of the
+    current chunk."""
+
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, fp, chunk_size=STREAM_CHUNK_SIZE, head=b""):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        # Bytes already read from fp before scanning started
+        self.buf = self.text.decode(head)
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        chunk = self.fp.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos :] + self.text.decode(chunk, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next non-whitespace character, or None at the end"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return None
+            self.fill()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected %r at offset %d but found %r" % (char, self.pos, found))
+        self.pos += 1
+
+    def decode_value(self):
+        self.peek()
+        # Each retry decodes the value from its start again, so the read size
+        # doubles while it is incomplete to keep large values linear
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill(size)
+            size *= 2
+
+    def iter_array(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Expected ',' or ']' in array but found %r" % char)
+
+    def iter_keys(self):
+        """Yields the keys of the top-level object. The caller has to consume
+        the value of each key before asking for the next one."""
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError("Expected ',' or '}' in object but found %r" % char)
+
+
+class JSONArrayStream(object):
+    """Iterates the elements of one top-level array of a JSON response as
+    they arrive, so only a single element is held in memory at a time."""
+
+    def __init__(self, response, key, url, head=b""):
+        self.response = response
+        self.key = key
+        self.url = url
+        self.head = head
+        # Set when the body could not be parsed to its end
+        self.failed = False
+
+    def __iter__(self):
+        reader = JSONStreamReader(self.response, head=self.head)
+        self.head = b""
+        try:
+            for name in reader.iter_keys():
+                if reader.peek() != "[":
+                    reader.decode_value()
+                elif name == self.key:
+                    for element in reader.iter_array():
+                        yield element
+                else:
+                    for _ in reader.iter_array():
+                        pass
+        except (ValueError, zlib.error) as e:
+            self.failed = True
+            collectd.error("ERROR: JSON parsing failed: (%s) %s" % (e, self.url))
+        finally:
+            self.close()
+
+    @property
+    def complete(self):
+        return not self.failed
+
+    def close(self):
+        self.response.close()
+
+
+# Reads kept in a capture directory before the oldest are removed
+CAPTURE_READS = 10
+
+
+class Capture(object):
+    """Records the API responses of a config for replay. Every read gets a
+    directory under the capture directory holding read.json, one gzip file
+    per response body and index.jsonl with the URL, status and timing of
+    each response. Only the last max_reads reads are kept."""
+
+    def __init__(self, directory, max_reads, prefix):
+        self.directory = directory
+        self.max_reads = max_reads
+        self.prefix = prefix
+        self.read_dir = None
+        self.read_started = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def begin_read(self, conf):
+        read_dir = os.path.join(self.directory, "read-%017.6f" % time.time())
+        with self.lock:
+            self.read_dir = None
+            self.sequence = 0
+            self.read_started = time.monotonic()
+        try:
+            os.makedirs(read_dir)
+            with open(os.path.join(read_dir, "read.json"), "w") as f:
+                json.dump(
+                    {
+                        "time": time.time(),
+                        "master": conf["is_master"],
+                        "mesos_version": conf.get("mesos_version"),
+                        "instance": conf["instance"],
+                        "cluster": conf["cluster"],
+                        "netloc": "%s:%s" % (conf["host"], conf["port"]),
+                    },
+                    f,
+                )
+            reads = sorted(name for name in os.listdir(self.directory) if name.startswith("read-"))
+            for name in reads[: max(0, len(reads) - self.max_reads)]:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        except OSError as e:
+            collectd.warning("%s plugin: Not capturing this read: %s" % (self.prefix, e))
+            return
+        with self.lock:
+            self.read_dir = read_dir
+
+    def record(self, url, status, started):
+        """Returns a CapturedResponse for a response whose headers arrived,
+        or None when the read is not being captured"""
+        with self.lock:
+            if self.read_dir is None:
+                return None
+            self.sequence += 1
+            read_dir = self.read_dir
+            path = os.path.join(read_dir, "%04d.gz" % self.sequence)
+            read_started = self.read_started
+        try:
+            body = gzip.open(path, "wb", compresslevel=1)
+        except OSError as e:
+            collectd.warning("%s plugin: Not capturing %s: %s" % (self.prefix, url, e))
+            return None
+        split = urllib.parse.urlsplit(url)
+        entry = {
+            "netloc": split.netloc,
+            "path": split.path + ("?" + split.query if split.query else ""),
+            "status": status,
+            "body": os.path.basename(path),
+            "started": started - read_started,
+            "latency": time.monotonic() - started,
+        }
+        return CapturedResponse(self, read_dir, entry, body, started)
+
+    def append(self, read_dir, entry):
+        """Indexes a captured response in the directory of its read"""
+        with self.lock:
+            try:
+                with open(os.path.join(read_dir, "index.jsonl"), "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError as e:
+                collectd.warning("%s plugin: Failed to index captured %s: %s" % (self.prefix, entry["path"], e))
+
+
+class CapturedResponse(object):
+    """Body of one captured response, written as it is read"""
+
+    def __init__(self, capture, read_dir, entry, body, started):
+        self.capture = capture
+        self.read_dir = read_dir
+        self.entry = entry
+        self.body = body
+        self.started = started
+
+    def write(self, data):
+        self.body.write(data)
+
+    def finish(self, received):
+        self.body.close()
+        self.entry["elapsed"] = time.monotonic() - self.started
+        self.entry["bytes"] = received
+        self.capture.append(self.read_dir, self.entry)
+
+
+def make_api_call(url, conf, context, headers, data, retry=True):
+    try:
+        timeouts = (conf.get("connect_timeout", CONNECT_TIMEOUT), conf.get("read_timeout", READ_TIMEOUT))
+        if conf.get("compress_responses"):
+            headers = dict(headers)
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
+        started = time.monotonic()
+        response = HTTP_POOL.request(url, headers, data, context, timeouts)
+        stats = conf.get("plugin_stats")
+        if stats is not None:
+            endpoint = stats.endpoint_for(conf, url)
+            stats.record_request(endpoint, time.monotonic() - started)
+            response.on_done = functools.partial(stats.record_bytes, endpoint)
+        capture = conf.get("capture")
+        # Login responses carry the DC/OS token and are never captured
+        if capture is not None and url != conf.get("dcos_url"):
+            response.capture = capture.record(url, response.status, started)
+        if response.status >= 300:
+            body = response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
         return response
     except urllib.error.HTTPError as e:
         try:
             # 401 errors need to be logged as errors under the following circumstances:
             # i.  Getting the Authentication token fails
             # ii. Plugin is deployed in an environment it doesn't support
-            # 401 errors need to be suppressed with log_verbose if it is caused by a timed-out token
-            # one way to identify this is using the endpoint - /acs/api/v1/auth/login
-            if e.code == 401 and conf.get("dcos_url", None) and url.endswith("/acs/api/v1/auth/login"):
-                log_verbose(conf.get("Verbose", False), "INFO: Refreshing DC/OS authentication token.")
+            # 401 errors need to be suppressed with log_verbose if it is caused by a timed-out token,
+            # in which case the request is sent again once with a refreshed token
+            if e.code == 401 and retry and conf.get("dcos_token") and url != conf["dcos_url"]:
+                log_verbose(conf, "INFO: Refreshing DC/OS authentication token.")
                 refresh_dcos_auth_token(conf)
-            elif e.code == 307 and not conf.get("dcos_url", None):
+                headers = dict(headers)
+                headers.update(get_auth_header(conf))
+                return make_api_call(url, conf, context, headers, data, retry=False)
+            record_request_error(conf, url, e)
+            if e.code == 307 and not conf.get("dcos_url", None):
                 log_verbose(
-                    conf.get("Verbose", False),
+                    conf,
                     "INFO: Skipping API call to %s because this master is not the leader (%s)." % (url, e),
                 )
             else:
@@ -328,15 +2062,8 @@ def make_api_call(url, conf, context, headers, data):
 
 def refresh_dcos_auth_token(conf):
     try:
-        token = get_dcos_auth_token(
-            conf["dcos_sfx_username"],
-            conf["dcos_sfx_password"],
-            conf["host"],
-            conf["dcos_url"],
-            conf.get("Verbose", False),
-        )
-        conf["dcos_auth_token"] = token
-        conf["dcos_auth_header"] = {"Authorization": ("token=%s" % (str(token)))}
+        conf["dcos_token"].refresh(conf["dcos_auth_token"])
+        get_auth_header(conf)
     except Exception as e:
         collectd.error("Refreshing token failed (%s)." % (e))
 
@@ -344,10 +2071,10 @@ def refresh_dcos_auth_token(conf):
 def dispatch_system_health(metric_value, metric_name, metric_type, conf, dims):
     """Dispatch a system health metric value"""
     if metric_value is None:
-        log_verbose(conf["verboseLogging"], "%s plugin: Value not found for %s" % (PREFIX, metric_name))
+        log_verbose(conf, "Value not found for %s" % metric_name)
         return
     log_verbose(
-        conf["verboseLogging"],
+        conf,
         "Sending value[%s]: %s=%s for instance:%s" % (metric_type, metric_name, metric_value, conf["instance"]),
     )
 
@@ -362,179 +2089,1300 @@ def dispatch_system_health(metric_value, metric_name, metric_type, conf, dims):
     val.plugin_instance = "%s[plugin_type=%s%s%s]" % (conf["instance"], plugin_type, cluster_dimension, dims)
     val.meta = {"0": True}
     val.dispatch()
+    if conf.get("plugin_stats") is not None:
+        conf["plugin_stats"].dispatched += 1
+
+
+# Rules inferring the type of discovered snapshot keys that are not listed
+# in the stat tables; everything else is a gauge
+STAT_TYPE_RULES = (
+    ("percent", ("*_percent",)),
+    ("bytes", ("*_bytes",)),
+    (
+        "counter",
+        (
+            "*/messages_*",
+            "*/valid_*",
+            "*/invalid_*",
+            "*/dropped_messages",
+            "*_registrations",
+            "*_reregistrations",
+            "*_removals",
+            "*_errors",
+            "*/tasks_dropped",
+            "*/tasks_error",
+            "*/tasks_failed",
+            "*/tasks_finished",
+            "*/tasks_gone",
+            "*/tasks_gone_by_operator",
+            "*/tasks_killed",
+            "*/tasks_lost",
+            "*/task_lost/*",
+            "*/executors_terminated",
+            "*/slave_shutdowns_*",
+        ),
+    ),
+)
+
+
+def compile_patterns(patterns):
+    """Compiles glob patterns into the match method of one combined regex,
+    None if there are no patterns."""
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(p) for p in patterns)).match
+
+
+STAT_TYPE_MATCHERS = tuple((stat_type, compile_patterns(patterns)) for stat_type, patterns in STAT_TYPE_RULES)
+
+
+def infer_stat_type(key):
+    for stat_type, match in STAT_TYPE_MATCHERS:
+        if match(key):
+            return stat_type
+    return "gauge"
+
+
+# Templates turning dynamic snapshot keys into a metric name plus dimensions.
+# "{name}" captures one key segment as a dimension, "{name:regex}" captures
+# text matching the regex and "*" matches anything. Captured segments are
+# removed from the metric name. The first matching template wins.
+DEFAULT_STAT_TEMPLATES = (
+    "allocator/mesos/roles/{role}/*",
+    "allocator/mesos/quota/roles/{role}/*",
+    "master/frameworks/{framework}/{mesos_framework_id}/*",
+    "*/{quantile:p[0-9]+|min|max|count}",
+)
+TEMPLATE_TOKEN = re.compile(r"\{(\w+)(?::([^}]*))?\}|\*")
+TEMPLATE_CACHE_SIZE = 65536
+
+StatTemplate = collections.namedtuple("StatTemplate", ("template", "match", "dimensions"))
+
+
+def compile_stat_template(template):
+    pattern = []
+    dimensions = []
+    pos = 0
+    for token in TEMPLATE_TOKEN.finditer(template):
+        pattern.append(re.escape(template[pos : token.start()]))
+        if token.group(0) == "*":
+            pattern.append(".*")
+        else:
+            dimensions.append(token.group(1))
+            pattern.append("(?P<%s>%s)" % (token.group(1), token.group(2) or "[^/]+"))
+        pos = token.end()
+    pattern.append(re.escape(template[pos:]))
+    return StatTemplate(template, re.compile("".join(pattern) + r"\Z").match, tuple(dimensions))
+
+
+def get_stat_templates(conf):
+    templates = conf.get("compiled_stat_templates")
+    if templates is None:
+        templates = []
+        for template in conf.get("stat_templates", ()):
+            try:
+                templates.append(compile_stat_template(template))
+            except re.error as e:
+                collectd.warning("%s plugin: Invalid StatsTemplate %s (%s)." % (conf["prefix"], template, e))
+        conf["compiled_stat_templates"] = templates
+    return templates
+
+
+def parse_templated_key(conf, key):
+    """Returns (metric name, dimensions) for a key matching one of the stat
+    templates, or None. Results are cached per distinct key."""
+    cache = conf.setdefault("template_cache", {})
+    if key in cache:
+        return cache[key]
+    parsed = None
+    for template in get_stat_templates(conf):
+        match = template.match(key)
+        if match is None:
+            continue
+        name = []
+        pos = 0
+        for dimension in template.dimensions:
+            start, end = match.span(dimension)
+            # Drop the captured segment together with one adjacent separator
+            if start > 0 and key[start - 1] == "/":
+                start -= 1
+            elif end < len(key) and key[end] == "/":
+                end += 1
+            name.append(key[pos:start])
+            pos = end
+        name.append(key[pos:])
+        parsed = ("".join(name), tuple((d, match.group(d)) for d in template.dimensions))
+        break
+    if len(cache) >= TEMPLATE_CACHE_SIZE:
+        cache.clear()
+    cache[key] = parsed
+    return parsed
+
+
+def get_snapshot_stats(conf, plan, json):
+    """Returns (planned stat, plugin_instance) pairs for the snapshot. The
+    table stats are complemented with keys matching a stat template, or in
+    discovery mode replaced by every numeric key passing the configured
+    include and exclude patterns. Keys listed in the tables keep their table
+    name and type. The result is cached against the key set of the snapshot,
+    so it is only rebuilt when keys come or go."""
+    cached = conf.get("snapshot_stats")
+    if cached is not None and json.keys() == cached[0]:
+        return cached[1]
+    discover = conf.get("discover_stats")
+    include = compile_patterns(conf.get("stats_include"))
+    exclude = compile_patterns(conf.get("stats_exclude"))
+    overrides = dict((planned.path, planned) for planned in plan.stats)
+    stats = []
+    if not discover:
+        stats.extend((planned, None) for planned in plan.stats)
+    for key, value in json.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        planned = overrides.get((key,))
+        if planned is not None and not discover:
+            continue
+        if (include is not None and not include(key)) or (exclude is not None and exclude(key)):
+            continue
+        if planned is not None:
+            stats.append((planned, None))
+            continue
+        templated = parse_templated_key(conf, key)
+        if templated is None:
+            if not discover:
+                continue
+            templated = (key, ())
+        name, dimensions = templated
+        planned = PlannedStat(name, Stat(infer_stat_type(name), key), (key,), None, compile_accessor((key,)))
+        stats.append((planned, get_plugin_instance(conf, dict(dimensions)) if dimensions else None))
+    stats = tuple(stats)
+    conf["snapshot_stats"] = (frozenset(json), stats)
+    log_verbose(conf, "Collecting %d stats from %d snapshot keys" % (len(stats), len(json)))
+    return stats
 
 
 def parse_stats(conf, json):
-    global ELECTED
     """Parse stats response from Mesos"""
-    if IS_MASTER:
+    plan = get_metric_plan(conf)
+    if conf["is_master"]:
         # Ignore stats if coming from non-leading mesos master
-        elected_result = lookup_stat("master/elected", json, conf)
-        ELECTED = elected_result
-        if elected_result == 1:
-            for name, key in list(get_stats_string(conf["version"]).items()):
-                result = lookup_stat(name, json, conf)
-                dispatch_stat(result, name, key, conf)
-        else:
+        elected_result = None
+        if plan.elected is not None:
+            elected_result = lookup_planned_stat(plan.elected, json)
+        conf["elected"] = elected_result
+        if elected_result != 1:
             # Always dispatch the election stat from each master
-            dispatch_stat(elected_result, "master/elected", get_stats_string(conf["version"])["master/elected"], conf)
-            log_verbose(conf["verboseLogging"], "This mesos master node is not elected leader so not " "writing data.")
+            if plan.elected is not None:
+                dispatch_stat(elected_result, plan.elected.name, plan.elected.key, conf)
+            log_verbose(conf, "This mesos master node is not elected leader so not " "writing data.")
             return None
-    else:
-        for name, key in list(get_stats_string(conf["version"]).items()):
-            result = lookup_stat(name, json, conf)
-            dispatch_stat(result, name, key, conf)
+    if conf.get("discover_stats") or conf.get("stat_templates"):
+        stats = get_snapshot_stats(conf, plan, json)
+        for planned, plugin_instance in stats:
+            result = lookup_planned_stat(planned, json)
+            dispatch_stat(result, planned.name, planned.key, conf, plugin_instance=plugin_instance)
+        return len(stats)
+    for planned in plan.stats:
+        result = lookup_planned_stat(planned, json)
+        dispatch_stat(result, planned.name, planned.key, conf)
+    return len(plan.stats)
 
 
 def parse_framework_stats(conf, json):
     """Parse framework stats responses from Mesos"""
-    global ELECTED
-    if IS_MASTER:
+    if conf["is_master"]:
         # Ignore stats if coming from non-leading mesos master
-        if ELECTED == 1:
+        if conf.get("elected") == 1:
             if "frameworks" in json:
+                plan = get_metric_plan(conf)
+                singles, groups = get_entity_stats(conf, "frameworks")
+                total = 0
                 for framework in json["frameworks"]:
-                    dimensions = {}
-                    for name, key in list(get_dimension_string(conf["version"])["FRAMEWORK"].items()):
-                        result = dig_it_up(framework, key)
-                        dimensions[name] = str(result)
-                    for name, key in list(get_framework_string(conf["version"]).items()):
-                        result = lookup_framework_stat(name, framework, conf)
-
-                        # Patch for framework.is_active
-                        if name == "framework.is_active":
-                            result = int(result)
-                        dispatch_stat(result, name, key, conf, dimensions)
+                    total += 1
+                    plugin_instance = get_entity_instance(
+                        conf,
+                        plan.framework_dimensions.names,
+                        dimension_values(framework, plan.framework_dimensions),
+                    )
+                    for planned in singles:
+                        result = lookup_planned_stat(planned, framework)
+                        dispatch_stat(result, planned.name, planned.key, conf, plugin_instance=plugin_instance)
+                    for group in groups:
+                        dispatch_resources(conf, group, framework, plugin_instance)
+                return total
             else:
-                log_verbose(conf["verboseLogging"], "No framework data was returned by the api")
+                log_verbose(conf, "No framework data was returned by the api")
         else:
-            log_verbose(
-                conf["verboseLogging"], "This mesos master node is not elected leader so not " "writing framework data."
-            )
+            log_verbose(conf, "This mesos master node is not elected leader so not " "writing framework data.")
+
+
+TASK_TOTAL_STAT = Stat("gauge", "tasks")
+ROLLUP_STAT = Stat("gauge", "rollup")
+ROLLUP_QUANTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+# Tasks can be grouped by any task dimension of the metric plan or by state
+TaskGrouping = collections.namedtuple("TaskGrouping", ("names", "getters"))
+
+
+def get_task_dimension_paths(conf):
+    dimensions = get_metric_plan(conf).task_dimensions
+    paths = dict(zip(dimensions.names, dimensions.paths))
+    paths["task_state"] = ("state",)
+    return paths
+
+
+def get_task_groupings(conf):
+    """Returns the configured task rollup groupings, resolved against the
+    metric plan on first use."""
+    groupings = conf.get("task_groupings")
+    if groupings is None:
+        paths = get_task_dimension_paths(conf)
+        groupings = []
+        for names in conf.get("task_rollups", ()):
+            unknown = [name for name in names if name not in paths]
+            if unknown:
+                collectd.warning(
+                    "%s plugin: Unknown task rollup dimension(s): %s." % (conf["prefix"], ", ".join(unknown))
+                )
+                continue
+            groupings.append(TaskGrouping(tuple(names), tuple(compile_accessor(paths[name]) for name in names)))
+        conf["task_groupings"] = groupings
+    return groupings
+
+
+def get_task_allowlist(conf):
+    """Returns the per-task allowlist as (accessor, matcher) pairs"""
+    allowlist = conf.get("task_allowlist")
+    if allowlist is None:
+        paths = get_task_dimension_paths(conf)
+        allowlist = []
+        for entry in conf.get("per_task_allowlist", ()):
+            name, _, pattern = entry.partition("=")
+            if name not in paths:
+                collectd.warning("%s plugin: Unknown task dimension in PerTaskAllowlist: %s." % (conf["prefix"], entry))
+                continue
+            allowlist.append((compile_accessor(paths[name]), re.compile(fnmatch.translate(pattern)).match))
+        conf["task_allowlist"] = allowlist
+    return allowlist
+
+
+def emit_task_stats(conf, task, allowlist):
+    """Decides whether the per-task stats of a task are dispatched"""
+    if allowlist:
+        for get, match in allowlist:
+            if match(intern_value(get(task))):
+                return True
+        return False
+    return conf.get("per_task_metrics", True)
+
+
+TASK_ID = compile_accessor(("id",))
+
+
+class TaskSampler(object):
+    """Selects the tasks whose per-task stats are sent by a hash of their
+    task id, so that the same tasks are sent on every read and from every
+    collector. Each framework is sampled at the rate of the first
+    FrameworkSampleRate pattern matching its id, else at TaskSampleRate.
+    Sampled tasks of frameworks sampled below 1 get a task_sample_weight
+    dimension, the inverse of the rate, to scale sums and counts over them
+    by."""
+
+    def __init__(self, rate, framework_rates):
+        self.rate = rate
+        self.framework_rates = [(re.compile(fnmatch.translate(pattern)).match, r) for pattern, r in framework_rates]
+        # framework_id -> (hash threshold, weight or None)
+        self.frameworks = {}
+
+    def framework(self, framework_id):
+        sampling = self.frameworks.get(framework_id)
+        if sampling is None:
+            rate = self.rate
+            for match, framework_rate in self.framework_rates:
+                if match(str(framework_id)):
+                    rate = framework_rate
+                    break
+            rate = min(1.0, max(0.0, rate))
+            weight = intern_value("%g" % (1.0 / rate)) if 0.0 < rate < 1.0 else None
+            sampling = self.frameworks[framework_id] = (rate * 2**32, weight)
+        return sampling
+
+    def sample(self, task):
+        """Returns (sampled, weight) for a task, weight None when its
+        framework is not sampled down"""
+        threshold, weight = self.framework(task.get("framework_id"))
+        if weight is None:
+            return threshold > 0, None
+        task_id = TASK_ID(task)
+        if task_id.__class__ is not str:
+            task_id = str(task_id)
+        return zlib.crc32(task_id.encode("utf-8")) < threshold, weight
+
+
+SAMPLE_WEIGHT_DIMENSION = "task_sample_weight"
+
+
+def quantile(ordered, q):
+    """Nearest-rank quantile of a sorted sequence"""
+    return ordered[max(0, int(math.ceil(q * len(ordered))) - 1)]
+
+
+class TaskRollups(object):
+    """Accumulates the resources of the tasks of one read into per-group
+    arrays, then dispatches count, sum, min, max and quantiles per group."""
+
+    def __init__(self, groupings, resources):
+        self.groupings = groupings
+        self.resources = resources
+        self.groups = [{} for _ in groupings]
+
+    def add(self, task):
+        values = [lookup_planned_stat(planned, task) for planned in self.resources]
+        for grouping, groups in zip(self.groupings, self.groups):
+            key = tuple([intern_value(get(task)) for get in grouping.getters])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0] + [array.array("d") for _ in self.resources]
+            group[0] += 1
+            for series, value in zip(group[1:], values):
+                if value is not None:
+                    series.append(value)
+
+    def dispatch(self, conf):
+        for grouping, groups in zip(self.groupings, self.groups):
+            for key, group in groups.items():
+                plugin_instance = get_entity_instance(conf, grouping.names, key)
+                dispatch_stat(group[0], "task.rollup.count", ROLLUP_STAT, conf, plugin_instance=plugin_instance)
+                for planned, series in zip(self.resources, group[1:]):
+                    if not series:
+                        continue
+                    name = "task.rollup.%s" % planned.name[len("task.") :]
+                    ordered = sorted(series)
+                    rollup = [("sum", math.fsum(ordered)), ("min", ordered[0]), ("max", ordered[-1])]
+                    rollup += [(label, quantile(ordered, q)) for label, q in ROLLUP_QUANTILES]
+                    for label, value in rollup:
+                        dispatch_stat(
+                            value, "%s.%s" % (name, label), ROLLUP_STAT, conf, plugin_instance=plugin_instance
+                        )
 
 
 def parse_task_stats(conf, json):
     """Parse task stats responses from Mesos"""
-    global ELECTED
-    state_mapping = {
-        "TASK_RUNNING": 0,
-        "TASK_FINISHED": 1,
-        "TASK_STAGING": 2,
-        "TASK_STARTING": 3,
-        "TASK_KILLING": 4,
-        "TASK_LOST": 5,
-        "TASK_KILLED": 6,
-        "TASK_FAILED": 7,
-        "TASK_ERROR": 8,
-    }
-    if IS_MASTER:
+    if conf["is_master"]:
         # Ignore stats if coming from non-leading mesos master
-        if ELECTED == 1:
+        if conf.get("elected") == 1:
             if "tasks" in json:
+                plan = get_metric_plan(conf)
+                singles, groups = get_entity_stats(conf, "tasks")
+                allowlist = get_task_allowlist(conf)
+                rollups = None
+                groupings = get_task_groupings(conf)
+                if groupings:
+                    resources = [p for p in plan.tasks if p.name.startswith("task.resources.")]
+                    rollups = TaskRollups(groupings, resources)
+                sampler = conf.get("task_sampler")
+                weighted_names = plan.task_dimensions.names + (SAMPLE_WEIGHT_DIMENSION,)
+                total = 0
                 for task in json["tasks"]:
-                    dimensions = {}
-                    for name, key in list(get_dimension_string(conf["version"])["TASK"].items()):
-                        result = dig_it_up(task, key)
-                        dimensions[name] = str(result)
-                    for name, key in list(get_task_string(conf["version"]).items()):
-                        result = lookup_task_stat(name, task, conf)
-
-                        # Patch for task.state
-                        if name == "task.state":
-                            if result in state_mapping:
-                                result = state_mapping[result]
-                            else:
-                                result = 9
-                        dispatch_stat(result, name, key, conf, dimensions)
+                    total += 1
+                    if rollups is not None:
+                        rollups.add(task)
+                    weight = None
+                    if sampler is not None:
+                        # Before anything else is looked up in the task
+                        sampled, weight = sampler.sample(task)
+                        if not sampled:
+                            continue
+                    if not emit_task_stats(conf, task, allowlist):
+                        continue
+                    values = dimension_values(task, plan.task_dimensions)
+                    if weight is None:
+                        plugin_instance = get_entity_instance(conf, plan.task_dimensions.names, values)
+                    else:
+                        plugin_instance = get_entity_instance(conf, weighted_names, values + (weight,))
+                    for planned in singles:
+                        result = lookup_planned_stat(planned, task)
+                        dispatch_stat(result, planned.name, planned.key, conf, plugin_instance=plugin_instance)
+                    for group in groups:
+                        dispatch_resources(conf, group, task, plugin_instance)
+                if not getattr(json["tasks"], "complete", True):
+                    # Counts over part of the tasks would pass for valid ones
+                    log_verbose(conf, "Not sending task.total and rollups of an incomplete task list.")
+                    return total
+                if rollups is not None:
+                    rollups.dispatch(conf)
+                dispatch_stat(total, "task.total", TASK_TOTAL_STAT, conf)
+                return total
+            else:
+                log_verbose(conf, "No task data was returned by the api")
+        else:
+            log_verbose(conf, "This mesos master node is not elected leader so not " "writing task data.")
+
+
+# Bounded LRU cache of formatted plugin_instance strings, keyed by the
+# config and the entity dimension values. Every read looks the entities up
+# in the same order, so a cache smaller than that never hits; it is sized
+# from the entities of the last read of each config, at least this many.
+PLUGIN_INSTANCE_CACHE_SIZE = 65536
+PLUGIN_INSTANCE_CACHE = collections.OrderedDict()
+PLUGIN_INSTANCE_LOCK = threading.Lock()
+plugin_instance_cache_limit = PLUGIN_INSTANCE_CACHE_SIZE
+
+# collectd.Values pre-populated per metric type, dispatched with overrides
+VALUES_TEMPLATES = {}
+
+
+def get_plugin_instance(conf, dimensions=None):
+    """Returns the plugin_instance string carrying the dimensions of an
+    entity followed by the plugin_type and cluster dimensions."""
+    if not dimensions:
+        return get_entity_instance(conf, (), ())
+    return get_entity_instance(conf, tuple(dimensions), tuple(dimensions.values()))
+
+
+def get_entity_instance(conf, names, values):
+    """get_plugin_instance for dimension names and values given as tuples,
+    as the metric plan holds them, without building a dictionary per entity
+    on cache hits"""
+    cache_key = (conf["instance"], conf["is_master"], conf["cluster"], names, values)
+    conf["entity_lookups"] = conf.get("entity_lookups", 0) + 1
+    with PLUGIN_INSTANCE_LOCK:
+        plugin_instance = PLUGIN_INSTANCE_CACHE.get(cache_key)
+        if plugin_instance is not None:
+            PLUGIN_INSTANCE_CACHE.move_to_end(cache_key)
+            return plugin_instance
+    formatted = dict(zip(names, values))
+    formatted.setdefault("plugin_type", "master" if conf["is_master"] else "slave")
+    formatted["cluster"] = conf["cluster"] or ""
+    plugin_instance = "{instance}[{dims}]".format(instance=conf["instance"], dims=_d(formatted))
+    with PLUGIN_INSTANCE_LOCK:
+        PLUGIN_INSTANCE_CACHE[cache_key] = plugin_instance
+        if len(PLUGIN_INSTANCE_CACHE) > plugin_instance_cache_limit:
+            PLUGIN_INSTANCE_CACHE.popitem(last=False)
+    return plugin_instance
+
+
+def resize_plugin_instance_cache(conf):
+    """Records the entities looked up by the read of a config that just
+    finished and sizes the plugin_instance cache to hold those of all
+    configs"""
+    global plugin_instance_cache_limit
+    conf["entity_count"] = conf.pop("entity_lookups", 0)
+    entities = sum(c.get("entity_count", 0) for c in CONFIGS)
+    plugin_instance_cache_limit = max(PLUGIN_INSTANCE_CACHE_SIZE, entities)
+
+
+def get_values_template(metric_type):
+    val = VALUES_TEMPLATES.get(metric_type)
+    if val is None:
+        val = collectd.Values(plugin="mesos", type=metric_type)
+        # https://github.com/collectd/collectd/issues/716
+        val.meta = {"0": True}
+        VALUES_TEMPLATES[metric_type] = val
+    return val
+
+
+# Value types that are always dispatched by the emission filter
+PASS_THROUGH_TYPES = frozenset(("counter", "derive"))
+HEARTBEAT_INTERVAL = 300
+
+
+class EmissionFilter(object):
+    """Remembers the last value sent per series and suppresses unchanged
+    values until the heartbeat period has passed since they were sent."""
+
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        # (plugin_instance, type_instance) -> (value, sent_at, seen_at)
+        self.series = {}
+        self.suppressed = 0
+
+    def should_send(self, plugin_instance, name, value):
+        now = time.monotonic()
+        key = (plugin_instance, name)
+        entry = self.series.get(key)
+        if entry is not None and entry[0] == value and now - entry[1] < self.heartbeat:
+            self.series[key] = (value, entry[1], now)
+            self.suppressed += 1
+            return False
+        self.series[key] = (value, now, now)
+        return True
+
+    def evict(self):
+        """Forgets series that have not been seen for a heartbeat period"""
+        cutoff = time.monotonic() - self.heartbeat
+        stale = [key for key, entry in self.series.items() if entry[2] < cutoff]
+        for key in stale:
+            del self.series[key]
+
+
+class ContainerSamples(object):
+    """Previous samples of the cumulative statistics of each container. Every
+    field is kept in one array with a slot per container; slots of containers
+    that disappear are reused."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.slots = {}
+        self.free = []
+        self.timestamps = array.array("d")
+        self.seen = array.array("L")
+        self.values = [array.array("d") for _ in range(fields)]
+        self.generation = 0
+
+    def begin(self):
+        self.generation += 1
+
+    def update(self, key, timestamp, values):
+        """Stores a sample and returns the per-second rate of each field
+        since the previous one, None for fields without a valid rate."""
+        nan = float("nan")
+        slot = self.slots.get(key)
+        rates = None
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
             else:
-                log_verbose(conf["verboseLogging"], "No task data was returned by the api")
+                slot = len(self.timestamps)
+                self.timestamps.append(nan)
+                self.seen.append(0)
+                for series in self.values:
+                    series.append(nan)
+            self.slots[key] = slot
         else:
-            log_verbose(
-                conf["verboseLogging"], "This mesos master node is not elected leader so not " "writing task data."
+            elapsed = timestamp - self.timestamps[slot]
+            if elapsed <= 0:
+                # Mesos served a cached sample, keep the previous one
+                self.seen[slot] = self.generation
+                return None
+            rates = []
+            for series, value in zip(self.values, values):
+                previous = series[slot]
+                # NaN never compares greater or equal, counter resets go negative
+                if value is None or not value >= previous:
+                    rates.append(None)
+                else:
+                    rates.append((value - previous) / elapsed)
+        self.timestamps[slot] = timestamp
+        self.seen[slot] = self.generation
+        for series, value in zip(self.values, values):
+            series[slot] = nan if value is None else value
+        return rates
+
+    def evict(self):
+        """Frees the slots of containers missing from the latest sample"""
+        for key, slot in list(self.slots.items()):
+            if self.seen[slot] != self.generation:
+                del self.slots[key]
+                self.free.append(slot)
+
+
+CONTAINER_UTILIZATION_STAT = Stat("percent", "utilization")
+# Rates summed into the utilization, throttled time is not time spent running
+CONTAINER_CPU_TIME_PATHS = frozenset(("statistics.cpus_user_time_secs", "statistics.cpus_system_time_secs"))
+
+
+def parse_container_stats(conf, json):
+    """Parse the per-executor statistics of an agent's /monitor/statistics"""
+    plan = get_metric_plan(conf)
+    samples = conf.get("container_samples")
+    if samples is None:
+        samples = conf["container_samples"] = ContainerSamples(len(plan.container_rates))
+    return dispatch_container_stats(conf, json, samples)
+
+
+def dispatch_container_stats(conf, json, samples, agent_dimensions=None):
+    """Dispatches the statistics of each container of one agent, computing
+    rates against the previous samples of that agent"""
+    plan = get_metric_plan(conf)
+    samples.begin()
+    for container in json:
+        dimensions = extract_dimensions(container, plan.container_dimensions)
+        if agent_dimensions:
+            dimensions.update(agent_dimensions)
+        plugin_instance = get_plugin_instance(conf, dimensions)
+        statistics = container.get("statistics", {})
+        for planned in plan.containers:
+            result = lookup_planned_stat(planned, container)
+            dispatch_stat(result, planned.name, planned.key, conf, plugin_instance=plugin_instance)
+        timestamp = statistics.get("timestamp")
+        if timestamp is None:
+            continue
+        key = container.get("container_id") or (container.get("framework_id"), container.get("executor_id"))
+        values = [lookup_planned_stat(planned, container) for planned in plan.container_rates]
+        rates = samples.update(key, timestamp, values)
+        if rates is None:
+            continue
+        cpus = None
+        for planned, rate in zip(plan.container_rates, rates):
+            dispatch_stat(rate, planned.name, planned.key, conf, plugin_instance=plugin_instance)
+            if rate is not None and planned.key.path in CONTAINER_CPU_TIME_PATHS:
+                cpus = (cpus or 0) + rate
+        cpus_limit = statistics.get("cpus_limit")
+        if cpus is not None and cpus_limit:
+            dispatch_stat(
+                100.0 * cpus / cpus_limit,
+                "executor.cpus.utilization",
+                CONTAINER_UTILIZATION_STAT,
+                conf,
+                plugin_instance=plugin_instance,
             )
+        mem_limit = statistics.get("mem_limit_bytes")
+        if mem_limit and statistics.get("mem_rss_bytes") is not None:
+            dispatch_stat(
+                100.0 * statistics["mem_rss_bytes"] / mem_limit,
+                "executor.mem.utilization",
+                CONTAINER_UTILIZATION_STAT,
+                conf,
+                plugin_instance=plugin_instance,
+            )
+    samples.evict()
+    return len(json)
 
 
-def dispatch_stat(result, name, key, conf, dimensions=None):
-    """Read a key from info response data and dispatch a value"""
+def dispatch_stat(result, name, key, conf, dimensions=None, plugin_instance=None):
+    """Read a key from info response data and dispatch a value. Callers
+    dispatching several stats of one entity should pass its plugin_instance
+    from get_plugin_instance instead of the dimensions."""
     if result is None:
-        log_verbose(conf["verboseLogging"], "%s plugin: Value not found for %s" % (PREFIX, name))
+        log_verbose(conf, "Value not found for %s" % name)
         return
-    if dimensions is None:
-        dimensions = {}
-    estype = key.type
-    value = result
-    log_verbose(
-        conf["verboseLogging"], "Sending value[%s]: %s=%s for instance:%s" % (estype, name, value, conf["instance"])
+    if conf["verboseLogging"]:
+        log_verbose(conf, "Sending value[%s]: %s=%s for instance:%s" % (key.type, name, result, conf["instance"]))
+    if plugin_instance is None:
+        plugin_instance = get_plugin_instance(conf, dimensions)
+    emission_filter = conf.get("emission_filter")
+    if emission_filter is not None and key.type not in PASS_THROUGH_TYPES:
+        if not emission_filter.should_send(plugin_instance, name, result):
+            return
+    get_values_template(key.type).dispatch(type_instance=name, plugin_instance=plugin_instance, values=[result])
+    stats = conf.get("plugin_stats")
+    if stats is not None:
+        stats.dispatched += 1
+
+
+# Multi-value type of mesos_types.db, whose data sources are the resources
+# in this order. With MultiValueResources, the task and framework gauges
+# named <group>.<resource> are dispatched as one value list per group.
+RESOURCES_TYPE = "mesos_resources"
+RESOURCE_NAMES = ("cpus", "mem", "disk", "gpus")
+NAN = float("nan")
+
+ResourceGroup = collections.namedtuple("ResourceGroup", ("name", "stats"))
+
+
+def resources_type_defined():
+    """Tells whether collectd knows the resources type. Without
+    collectd.get_dataset (collectd < 5.5) this can't be checked."""
+    get_dataset = getattr(collectd, "get_dataset", None)
+    if get_dataset is None:
+        return True
+    try:
+        get_dataset(RESOURCES_TYPE)
+        return True
+    except TypeError:
+        return False
+
+
+def group_resource_stats(planned_stats):
+    """Splits planned stats into the stats dispatched alone and the groups
+    of resource gauges, each listing its stats in RESOURCE_NAMES order with
+    None for the resources the tables lack"""
+    singles = []
+    groups = collections.OrderedDict()
+    for planned in planned_stats:
+        group, _, resource = planned.name.rpartition(".")
+        if resource in RESOURCE_NAMES and planned.key.type == "gauge":
+            stats = groups.setdefault(group, [None] * len(RESOURCE_NAMES))
+            stats[RESOURCE_NAMES.index(resource)] = planned
+        else:
+            singles.append(planned)
+    return tuple(singles), tuple(ResourceGroup(name, tuple(stats)) for name, stats in groups.items())
+
+
+def get_entity_stats(conf, kind):
+    """Returns the single stats and resource groups of the "tasks" or
+    "frameworks" stats of the metric plan. Without MultiValueResources every
+    stat is single."""
+    planned = getattr(get_metric_plan(conf), kind)
+    if not conf.get("multi_value_resources"):
+        return planned, ()
+    cached = conf["entity_stats"].get(kind)
+    if cached is None or cached[0] is not planned:
+        cached = conf["entity_stats"][kind] = (planned, group_resource_stats(planned))
+    return cached[1]
+
+
+def dispatch_resources(conf, group, obj, plugin_instance):
+    """Dispatches the resources of a group as one value list, NaN standing
+    for missing resources. Groups with no resource at all are skipped."""
+    values = []
+    found = False
+    for planned in group.stats:
+        value = None if planned is None else lookup_planned_stat(planned, obj)
+        if value is None:
+            value = NAN
+        else:
+            found = True
+        values.append(value)
+    if not found:
+        log_verbose(conf, "Value not found for %s" % group.name)
+        return
+    if conf["verboseLogging"]:
+        log_verbose(
+            conf, "Sending values[%s]: %s=%s for instance:%s" % (RESOURCES_TYPE, group.name, values, conf["instance"])
+        )
+    emission_filter = conf.get("emission_filter")
+    if emission_filter is not None and not emission_filter.should_send(plugin_instance, group.name, values):
+        return
+    get_values_template(RESOURCES_TYPE).dispatch(
+        type_instance=group.name, plugin_instance=plugin_instance, values=values
     )
-    val = collectd.Values(plugin="mesos")
-    val.type = estype
-    val.type_instance = name
-    val.values = [value]
-    dimensions["plugin_type"] = "master" if IS_MASTER else "slave"
-    dimensions["cluster"] = ""
-    if conf["cluster"]:
-        dimensions["cluster"] = conf["cluster"]
-    val.plugin_instance = "{instance}[{dims}]".format(instance=conf["instance"], dims=_d(dimensions))
-    # https://github.com/collectd/collectd/issues/716
-    val.meta = {"0": True}
-    val.dispatch()
+    stats = conf.get("plugin_stats")
+    if stats is not None:
+        stats.dispatched += 1
+
+
+class PluginInstance(object):
+    """A configured Module block of the master or agent plugin. collectd
+    calls the read method of each instance from its own read callback, so
+    instances are read in parallel by the read threads, each with the metric
+    tables and state of its config."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.name = "%s-%s" % (conf["prefix"], conf["instance"])
+        self.lock = threading.Lock()
+        conf["plugin"] = self
+
+    def read(self, data=None):
+        with self.lock:
+            collect_all([self.conf])
+
+
+def register_instance(instance, interval=None):
+    """Registers the read callback of an instance under a name unique among
+    the configured instances, with its own interval if one is set"""
+    names = set(conf["plugin"].name for conf in CONFIGS if conf.get("plugin") and conf["plugin"] is not instance)
+    name = instance.name
+    suffix = 1
+    while name in names:
+        suffix += 1
+        name = "%s-%d" % (instance.name, suffix)
+    instance.name = name
+    if interval:
+        collectd.register_read(instance.read, interval, name=name)
+    else:
+        collectd.register_read(instance.read, name=name)
 
 
-def read_callback(
-    is_master,
-    stats_mesos,
-    stats_mesos_019,
-    stats_mesos_020,
-    stats_mesos_021,
-    stats_mesos_022,
-    stats_mesos_100,
-    framework_mesos=None,
-    task_mesos=None,
-    dimensions_mesos=None,
-):
-    global IS_MASTER
-    IS_MASTER = is_master
-    global STATS_MESOS
-    STATS_MESOS = stats_mesos
-    global STATS_MESOS_019
-    STATS_MESOS_019 = stats_mesos_019
-    global STATS_MESOS_020
-    STATS_MESOS_020 = stats_mesos_020
-    global STATS_MESOS_021
-    STATS_MESOS_021 = stats_mesos_021
-    global STATS_MESOS_022
-    STATS_MESOS_022 = stats_mesos_022
-    global STATS_MESOS_100
-    STATS_MESOS_100 = stats_mesos_100
-    global FRAMEWORK_MESOS
-    FRAMEWORK_MESOS = framework_mesos
-    global TASK_MESOS
-    TASK_MESOS = task_mesos
-    global DIMENSIONS_MESOS
-    DIMENSIONS_MESOS = dimensions_mesos
+def read_callback(prefix=None):
+    """Reads the instances configured by a plugin, or all of them, in turn.
+    collectd reads every instance through its own callback instead."""
+    for conf in list(CONFIGS):
+        if conf.get("plugin") is not None and prefix in (None, conf["prefix"]):
+            conf["plugin"].read()
 
-    for conf in CONFIGS:
+
+# Endpoints collected on every read, in the order they are parsed for a config.
+# The snapshot has to come first as it records whether a master is elected.
+Endpoint = collections.namedtuple("Endpoint", ("name", "url_key", "master_only", "fetch", "parse"))
+
+ENDPOINTS = (
+    Endpoint("snapshot", "mesos_url", False, fetch_endpoint, parse_stats),
+    Endpoint("system_health", "system_health_url", True, fetch_endpoint, parse_system_health),
+    Endpoint("frameworks", "framework_url", True, fetch_frameworks, parse_framework_stats),
+    Endpoint("tasks", "task_url", True, fetch_tasks, parse_task_stats),
+    Endpoint("agents", "slaves_url", True, fetch_agents, parse_agents),
+    Endpoint("containers", "monitor_url", False, fetch_endpoint, parse_container_stats),
+)
+
+
+def get_endpoints(conf):
+    """Returns the endpoints to collect for a config"""
+    return [e for e in ENDPOINTS if conf.get(e.url_key) and (conf["is_master"] or not e.master_only)]
+
+
+def get_fetch_pool(conf):
+    pool = conf.get("fetch_pool")
+    if pool is None:
+        pool = conf["fetch_pool"] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=conf["fetch_concurrency"], thread_name_prefix="mesos-fetch"
+        )
+    return pool
+
+
+def _completed(fn, *args):
+    """Runs fn inline and wraps the outcome like a finished future"""
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def submit_fetch(conf, fn, *args):
+    """Runs fn on the fetch pool of a config, or inline when fetching
+    serially"""
+    if conf.get("fetch_concurrency", FETCH_CONCURRENCY) > 1:
+        return get_fetch_pool(conf).submit(fn, *args)
+    return _completed(fn, *args)
+
+
+def snapshot_elected(conf, snapshot):
+    """Returns master/elected from a fetched snapshot, None if unknown"""
+    try:
+        result = snapshot.result(timeout=time_left(conf))
+    except Exception:
+        return None
+    plan = get_metric_plan(conf)
+    if not result or plan.elected is None:
+        return None
+    return lookup_planned_stat(plan.elected, result)
+
+
+# Config keys of the per-endpoint polling intervals
+INTERVAL_KEYS = {
+    "SnapshotInterval": "snapshot",
+    "HealthInterval": "system_health",
+    "FrameworkInterval": "frameworks",
+    "TaskInterval": "tasks",
+    "ContainerInterval": "containers",
+    "AgentInterval": "agents",
+}
+INTERVAL_JITTER = 0.1
+
+
+def endpoint_due(conf, endpoint, now):
+    """Tells whether an endpoint is due for collection and, if so, schedules
+    its next collection. Endpoints without an interval are collected on
+    every read. The first collection is delayed by a random fraction of the
+    interval, so that instances started together stay apart afterwards."""
+    interval = conf["intervals"].get(endpoint.name)
+    if not interval:
+        return True
+    next_poll = conf["next_poll"].get(endpoint.name)
+    if next_poll is None:
+        jitter = conf.get("interval_jitter", INTERVAL_JITTER) * interval
+        conf["next_poll"][endpoint.name] = now + random.uniform(0, jitter)
+        return False
+    if now < next_poll:
+        return False
+    next_poll += interval
+    if next_poll <= now:
+        # Reads fell behind, start over from now
+        next_poll = now + interval
+    conf["next_poll"][endpoint.name] = next_poll
+    return True
+
+
+def set_api_host(conf, netloc):
+    """Points the endpoint URLs of a config at another host:port"""
+    conf["api_netloc"] = netloc
+    base = conf["scheme"] + netloc
+    conf["mesos_url"] = base + "/metrics/snapshot"
+    conf["framework_url"] = base + "/master/frameworks"
+    conf["task_url"] = base + "/master/tasks"
+    if conf["slaves_url"]:
+        conf["slaves_url"] = base + "/master/slaves"
+    if conf["system_health_url"]:
+        conf["system_health_url"] = "{0}{1}:1050/system/health/v1".format(conf["scheme"], netloc.rsplit(":", 1)[0])
+
+
+def discover_leader(conf):
+    """Asks the configured master for the leading master through
+    /master/redirect and returns its host:port."""
+    url = "%s%s:%s/master/redirect" % (conf["scheme"], conf["host"], conf["port"])
+    timeouts = (conf["connect_timeout"], conf["read_timeout"])
+    response = HTTP_POOL.request(url, get_auth_header(conf), "", conf["ssl_context"], timeouts)
+    try:
+        response.read()
+    finally:
+        response.close()
+    location = response.headers.get("Location")
+    if response.status not in (301, 302, 303, 307, 308) or not location:
+        raise urllib.error.HTTPError(url, response.status, "No leader redirect", response.headers, None)
+    if "//" not in location:
+        location = "//" + location
+    return urllib.parse.urlsplit(location).netloc
+
+
+def follow_leader(conf):
+    """Re-discovers the leading master, returns True if it moved"""
+    leader = discover_leader(conf)
+    if leader == conf.get("leader"):
+        return False
+    log_verbose(conf, "Following leading master at %s" % leader)
+    conf["leader"] = leader
+    set_api_host(conf, leader)
+    return True
+
+
+def collect_snapshot(conf):
+    """Fetches the snapshot of a config. A config following the leader
+    locates it first, and again when the cached leader is no longer elected."""
+    if not conf.get("follow_leader"):
+        return fetch_endpoint(conf, conf["mesos_url"])
+    try:
+        if conf.get("leader") is None:
+            follow_leader(conf)
+        result = fetch_endpoint(conf, conf["mesos_url"])
+        plan = get_metric_plan(conf)
+        if plan.elected is not None and lookup_planned_stat(plan.elected, result or {}) != 1:
+            if follow_leader(conf):
+                result = fetch_endpoint(conf, conf["mesos_url"])
+        return result
+    except Exception:
+        conf["leader"] = None
+        raise
+
+
+class CircuitBreaker(object):
+    """Stops requests to an endpoint after threshold consecutive failures,
+    backing off exponentially, and then lets a single probe request through
+    to find out whether the endpoint recovered."""
+
+    def __init__(self, threshold, backoff, max_backoff):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self, now):
+        with self.lock:
+            if not self.threshold or self.failures < self.threshold:
+                return True
+            if self.probing or now < self.open_until:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, success):
+        with self.lock:
+            self.probing = False
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                exponent = min(self.failures - self.threshold, 16)
+                self.open_until = time.monotonic() + min(self.max_backoff, self.backoff * 2**exponent)
+
+
+BREAKER_THRESHOLD = 3
+BREAKER_BACKOFF = 10.0
+BREAKER_MAX_BACKOFF = 300.0
+
+
+def get_breaker(conf, name):
+    breaker = conf["breakers"].get(name)
+    if breaker is None:
+        breaker = conf["breakers"][name] = CircuitBreaker(
+            conf["breaker_threshold"], conf["breaker_backoff"], conf["breaker_max_backoff"]
+        )
+    return breaker
+
+
+def guarded_fetch(breaker, fn, *args):
+    """Runs a fetch and records in the breaker whether it returned data"""
+    success = False
+    try:
+        result = fn(*args)
+        success = result is not None
+        return result
+    finally:
+        breaker.record(success)
+
+
+def submit_guarded(conf, name, now, fn, *args):
+    """Submits a fetch unless the breaker of the endpoint is open or the
+    read deadline has passed, in which case None is returned."""
+    if past_deadline(conf):
+        log_verbose(conf, "Read deadline reached, not fetching %s." % name)
+        return None
+    breaker = get_breaker(conf, name)
+    if not breaker.allow(now):
+        log_verbose(conf, "Circuit open for %s, skipping it this read." % name)
+        return None
+    return submit_fetch(conf, guarded_fetch, breaker, fn, *args)
+
+
+def time_left(conf):
+    """Seconds left before the read deadline of a config, None without one"""
+    deadline = conf.get("deadline_at")
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def past_deadline(conf):
+    return time_left(conf) == 0.0
+
+
+def collect_all(configs):
+    """Fetches the due snapshots of all configs concurrently, then the other
+    due endpoints of agents and of elected masters, and finally parses the
+    responses config by config in endpoint order. Standby masters are not
+    asked for anything beyond their snapshot; masters whose snapshot is not
+    due this read are gated on the last election result seen."""
+    now = time.monotonic()
+    pending = []
+    for conf in configs:
+        log_verbose(conf, "Read callback called")
+        conf["deadline_at"] = now + conf["read_deadline"] if conf.get("read_deadline") else None
+        if conf.get("capture") is not None:
+            conf["capture"].begin_read(conf)
+        due = [e for e in get_endpoints(conf) if endpoint_due(conf, e, now)]
+        snapshot = None
+        if due and due[0].name == "snapshot":
+            snapshot = submit_guarded(conf, "snapshot", now, collect_snapshot, conf)
+            due = due[1:]
+        pending.append((conf, snapshot, due))
+
+    jobs = []
+    for conf, snapshot, due in pending:
+        if snapshot is not None:
+            jobs.append((conf, ENDPOINTS[0], snapshot))
+            conf["elected"] = snapshot_elected(conf, snapshot)
+        if conf["is_master"] and conf.get("elected") != 1:
+            if due:
+                log_verbose(conf, "Skipping leader-only endpoints of a non-elected master.")
+            continue
+        for endpoint in due:
+            future = submit_guarded(conf, endpoint.name, now, endpoint.fetch, conf, conf[endpoint.url_key])
+            if future is not None:
+                jobs.append((conf, endpoint, future))
+
+    failed = set()
+    finished = {}
+    for conf, endpoint, future in jobs:
+        if id(conf) in failed:
+            discard_result(future)
+            continue
+        result = None
         try:
-            log_verbose(conf["verboseLogging"], "Read callback called")
-            fetch_stats(conf)
-            if IS_MASTER:
-                fetch_system_health(conf)
-                fetch_framework_stats(conf)
-                fetch_task_stats(conf)
+            result = future.result(timeout=time_left(conf))
+            # An empty container list still frees the samples of the last ones
+            if result is not None:
+                parse_endpoint(conf, endpoint, result)
+        except concurrent.futures.TimeoutError as e:
+            collectd.error("Read deadline exceeded while fetching %s from %s" % (endpoint.name, conf["instance"]))
+            record_endpoint_error(conf, endpoint, e)
+            discard_result(future)
+            if endpoint.name == "snapshot":
+                failed.add(id(conf))
         except Exception as e:
             collectd.error("Error fetching metrics: %s" % e)
+            record_endpoint_error(conf, endpoint, e)
+            # Without the snapshot the election state is unknown
+            if endpoint.name == "snapshot":
+                failed.add(id(conf))
+        finally:
+            close_streams(result)
+            finished[id(conf)] = time.monotonic()
+
+    for conf in configs:
+        resize_plugin_instance_cache(conf)
+        if conf.get("plugin_stats") is not None:
+            dispatch_pool_stats(conf)
+            conf["plugin_stats"].dispatch(conf, finished.get(id(conf), time.monotonic()) - now)
+        if conf.get("emission_filter") is not None:
+            conf["emission_filter"].evict()
+
+
+def parse_endpoint(conf, endpoint, result):
+    """Parses the response of an endpoint, recording the time taken and the
+    entities and values processed in the plugin stats of the config"""
+    stats = conf.get("plugin_stats")
+    if stats is None:
+        endpoint.parse(conf, result)
+        return
+    emission_filter = conf.get("emission_filter")
+    suppressed = emission_filter.suppressed if emission_filter is not None else 0
+    dispatched = stats.dispatched
+    started = time.monotonic()
+    entities = endpoint.parse(conf, result)
+    if emission_filter is not None:
+        suppressed = emission_filter.suppressed - suppressed
+    stats.record_parse(endpoint.name, time.monotonic() - started, entities, stats.dispatched - dispatched, suppressed)
+
+
+def record_endpoint_error(conf, endpoint, error):
+    if conf.get("plugin_stats") is not None:
+        conf["plugin_stats"].record_error(endpoint.name, error)
+
+
+def dispatch_pool_stats(conf):
+    """Dispatch the connection pool counters for the host of a config"""
+    netloc = conf.get("api_netloc") or "%s:%s" % (conf["host"], conf["port"])
+    for name, key in HTTP_POOL_STATS.items():
+        dispatch_stat(getattr(HTTP_POOL, key.path)[netloc], name, key, conf)
+
+
+# Per-endpoint counters dispatched by PluginStats, named after its attributes
+PLUGIN_ENDPOINT_STATS = {
+    "plugin.requests": Stat("counter", "requests"),
+    "plugin.response.bytes": Stat("counter", "response_bytes"),
+    "plugin.response.decoded_bytes": Stat("counter", "decoded_bytes"),
+    "plugin.entities": Stat("counter", "entities"),
+    "plugin.values.dispatched": Stat("counter", "dispatched"),
+    "plugin.values.suppressed": Stat("counter", "suppressed"),
+}
+PLUGIN_ERRORS_STAT = Stat("counter", "errors")
+PLUGIN_GAUGE_STAT = Stat("gauge", "seconds")
+
+
+class EndpointStats(object):
+    """Collection costs of one endpoint of a config"""
+
+    def __init__(self):
+        self.requests = 0
+        self.response_bytes = 0
+        self.decoded_bytes = 0
+        self.entities = 0
+        self.dispatched = 0
+        self.suppressed = 0
+        self.errors = collections.Counter()
+        # Reset after every read
+        self.read_requests = 0
+        self.latency = 0.0
+        self.parse_time = None
+
+
+class PluginStats(object):
+    """Costs of collecting a config: request latency and response bytes are
+    recorded by the fetch threads, parse time, entities, dispatched values
+    and errors by the read. All of it is dispatched as plugin.* metrics with
+    an endpoint dimension after each read."""
+
+    def __init__(self):
+        self.endpoints = {}
+        self.paths = {}
+        # Values dispatched for the config, counted by dispatch_stat
+        self.dispatched = 0
+        self.lock = threading.Lock()
+
+    def endpoint(self, name):
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = EndpointStats()
+        return stats
+
+    def endpoint_for(self, conf, url):
+        """Returns the endpoint name for a request URL of the config.
+        Requests to hosts other than those of the endpoints are agent polls."""
+        split = urllib.parse.urlsplit(url)
+        name = self.paths.get(split.path)
+        if name is None:
+            name = split.path
+            if url == conf.get("dcos_url"):
+                name = "dcos_login"
+            for endpoint in ENDPOINTS:
+                if conf.get(endpoint.url_key) and urllib.parse.urlsplit(conf[endpoint.url_key]).path == split.path:
+                    name = endpoint.name
+            self.paths[split.path] = name
+        if conf.get("slaves_url") and name != "dcos_login":
+            netlocs = [urllib.parse.urlsplit(conf[e.url_key]).netloc for e in ENDPOINTS if conf.get(e.url_key)]
+            if split.netloc not in netlocs:
+                return "agents"
+        return name
+
+    def record_request(self, name, latency):
+        with self.lock:
+            stats = self.endpoint(name)
+            stats.requests += 1
+            stats.read_requests += 1
+            stats.latency += latency
+
+    def record_bytes(self, name, received, decoded):
+        with self.lock:
+            stats = self.endpoint(name)
+            stats.response_bytes += received
+            stats.decoded_bytes += decoded
+
+    def record_error(self, name, error):
+        with self.lock:
+            self.endpoint(name).errors[error.__class__.__name__] += 1
+
+    def record_parse(self, name, seconds, entities, dispatched, suppressed):
+        with self.lock:
+            stats = self.endpoint(name)
+            stats.parse_time = (stats.parse_time or 0.0) + seconds
+            stats.entities += entities or 0
+            stats.dispatched += dispatched
+            stats.suppressed += suppressed
+
+    def dispatch(self, conf, read_duration):
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+        for name, stats in endpoints:
+            plugin_instance = get_plugin_instance(conf, {"endpoint": name})
+            for metric, key in PLUGIN_ENDPOINT_STATS.items():
+                dispatch_stat(getattr(stats, key.path), metric, key, conf, plugin_instance=plugin_instance)
+            if stats.read_requests:
+                latency = stats.latency / stats.read_requests
+                dispatch_stat(
+                    latency, "plugin.request.latency", PLUGIN_GAUGE_STAT, conf, plugin_instance=plugin_instance
+                )
+            if stats.parse_time is not None:
+                dispatch_stat(
+                    stats.parse_time, "plugin.parse.time", PLUGIN_GAUGE_STAT, conf, plugin_instance=plugin_instance
+                )
+            for error, count in sorted(stats.errors.items()):
+                dispatch_stat(count, "plugin.errors", PLUGIN_ERRORS_STAT, conf, {"endpoint": name, "error": error})
+            with self.lock:
+                stats.read_requests = 0
+                stats.latency = 0.0
+                stats.parse_time = None
+        dispatch_stat(read_duration, "plugin.read.duration", PLUGIN_GAUGE_STAT, conf)
+
+
+def record_request_error(conf, url, error):
+    stats = conf.get("plugin_stats")
+    if stats is not None:
+        stats.record_error(stats.endpoint_for(conf, url), error)
+
+
+def discard_result(future):
+    """Releases the result of a fetch that will not be parsed, now or once
+    it completes."""
+
+    def release(done):
+        if not done.cancelled() and done.exception() is None:
+            close_streams(done.result())
+
+    future.add_done_callback(release)
+
+
+def shutdown_callback():
+    HTTP_POOL.close_all()
+    for conf in CONFIGS:
+        if conf.get("fetch_pool") is not None:
+            conf["fetch_pool"].shutdown(wait=False)
+            conf["fetch_pool"] = None
+        if conf.get("subscriber") is not None:
+            conf["subscriber"].stop()
+        if conf.get("agent_pool") is not None:
+            conf["agent_pool"].shutdown(wait=False)
+            conf["agent_pool"] = None
 
 
 def dig_it_up(obj, path):
+    if isinstance(path, (str, bytes)):
+        path = path.split(".")
     try:
-        if isinstance(path, (str, bytes)):
-            path = path.split(".")
-        return reduce(lambda x, y: x[y], path, obj)
-    except:
+        for key in path:
+            obj = obj[key]
+        return obj
+    except (KeyError, IndexError, TypeError):
         return None
 
 
-def log_verbose(enabled, msg):
-    if not enabled:
+def log_verbose(conf, msg):
+    if not conf.get("verboseLogging"):
         return
-    collectd.info("%s plugin [verbose]: %s" % (PREFIX, msg))
+    collectd.info("%s plugin [verbose]: %s" % (conf["prefix"], msg))
@@ -0,0 +1,98 @@
+import pytest
+
+import mesos_collectd
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mesos_collectd.time, "monotonic", clock)
+    return clock
+
+
+def fail(breaker, times):
+    for _ in range(times):
+        breaker.record(False)
+
+
+def test_closed_until_threshold(clock):
+    breaker = mesos_collectd.CircuitBreaker(3, 10.0, 300.0)
+    fail(breaker, 2)
+    assert breaker.allow(clock.now)
+    breaker.record(True)
+    fail(breaker, 2)
+    # A success in between resets the count
+    assert breaker.allow(clock.now)
+
+
+def test_opens_at_threshold_for_the_backoff(clock):
+    breaker = mesos_collectd.CircuitBreaker(3, 10.0, 300.0)
+    fail(breaker, 3)
+    assert not breaker.allow(clock.now)
+    assert not breaker.allow(clock.now + 9.9)
+    assert breaker.allow(clock.now + 10.0)
+
+
+def test_half_open_lets_a_single_probe_through(clock):
+    breaker = mesos_collectd.CircuitBreaker(3, 10.0, 300.0)
+    fail(breaker, 3)
+    later = clock.now + 10.0
+    assert breaker.allow(later)
+    assert not breaker.allow(later)
+    assert not breaker.allow(later + 100.0)
+
+
+def test_successful_probe_closes(clock):
+    breaker = mesos_collectd.CircuitBreaker(3, 10.0, 300.0)
+    fail(breaker, 3)
+    assert breaker.allow(clock.now + 10.0)
+    breaker.record(True)
+    assert breaker.allow(clock.now + 10.0)
+    assert breaker.allow(clock.now + 10.0)
+
+
+def test_failed_probe_doubles_the_backoff(clock):
+    breaker = mesos_collectd.CircuitBreaker(3, 10.0, 300.0)
+    fail(breaker, 3)
+    clock.now += 10.0
+    assert breaker.allow(clock.now)
+    breaker.record(False)
+    assert not breaker.allow(clock.now + 19.9)
+    assert breaker.allow(clock.now + 20.0)
+
+
+def test_backoff_is_capped(clock):
+    breaker = mesos_collectd.CircuitBreaker(3, 10.0, 300.0)
+    fail(breaker, 3 + 40)
+    assert breaker.open_until == clock.now + 300.0
+    assert breaker.allow(clock.now + 300.0)
+
+
+def test_zero_threshold_never_opens(clock):
+    breaker = mesos_collectd.CircuitBreaker(0, 10.0, 300.0)
+    fail(breaker, 100)
+    assert breaker.allow(clock.now)
+
+
+def test_guarded_fetch_records_missing_data_and_exceptions(clock):
+    breaker = mesos_collectd.CircuitBreaker(2, 10.0, 300.0)
+    assert mesos_collectd.guarded_fetch(breaker, lambda: None) is None
+
+    def broken():
+        raise IOError("connection refused")
+
+    with pytest.raises(IOError):
+        mesos_collectd.guarded_fetch(breaker, broken)
+    assert not breaker.allow(clock.now)
+    clock.now += 10.0
+    assert breaker.allow(clock.now)
+    assert mesos_collectd.guarded_fetch(breaker, lambda: {"ok": 1}) == {"ok": 1}
+    assert breaker.allow(clock.now)
@@ -0,0 +1,197 @@
+import base64
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import mesos_collectd
+
+LOG_CONF = {"prefix": "mesos-master", "verboseLogging": False}
+
+
+def make_token(claims):
+    def encode(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+    return "%s.%s.signature" % (encode({"alg": "RS256"}), encode(claims))
+
+
+class Logins(object):
+    """Stands in for get_dcos_auth_token, answering with the queued tokens"""
+
+    def __init__(self, *tokens, delay=0.0):
+        self.tokens = list(tokens)
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, uid, password, host, dcos_url, log_conf):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.tokens.pop(0) if self.tokens else None
+
+
+@pytest.fixture
+def logins(monkeypatch):
+    def install(*tokens, **kwargs):
+        logins = Logins(*tokens, **kwargs)
+        monkeypatch.setattr(mesos_collectd, "get_dcos_auth_token", logins)
+        return logins
+
+    return install
+
+
+def new_token(cache_file=None):
+    return mesos_collectd.DCOSToken(
+        "uid", "secret", "master", "https://dcos/acs/api/v1/auth/login", cache_file, LOG_CONF
+    )
+
+
+def write_cache(path, entries, mode=0o600):
+    with open(path, "w") as f:
+        json.dump(entries, f)
+    os.chmod(path, mode)
+
+
+def test_expiry_is_read_from_the_exp_claim():
+    # Payloads of every length, so every amount of base64 padding is needed
+    for exp in (1, 12, 123, 1234567890):
+        assert mesos_collectd.decode_token_expiry(make_token({"exp": exp})) == exp
+    assert mesos_collectd.decode_token_expiry(make_token({"uid": "a"})) is None
+    assert mesos_collectd.decode_token_expiry(make_token({"exp": "soon"})) is None
+    assert mesos_collectd.decode_token_expiry("not-a-jwt") is None
+    assert mesos_collectd.decode_token_expiry("a.!!!.c") is None
+    assert mesos_collectd.decode_token_expiry(None) is None
+
+
+def test_cached_token_is_used(tmp_path, logins):
+    cached = make_token({"exp": time.time() + 3600})
+    path = str(tmp_path / "token.json")
+    write_cache(path, {"uid@https://dcos/acs/api/v1/auth/login": cached, "other@x": "t"})
+    login = logins()
+    assert new_token(path).get() == cached
+    assert login.calls == 0
+
+
+def test_expired_cached_token_is_ignored(tmp_path, logins):
+    path = str(tmp_path / "token.json")
+    write_cache(path, {"uid@https://dcos/acs/api/v1/auth/login": make_token({"exp": time.time() - 1})})
+    fresh = make_token({"exp": time.time() + 3600})
+    logins(fresh)
+    assert new_token(path).get() == fresh
+
+
+@pytest.mark.parametrize("mode", [0o640, 0o604, 0o666])
+def test_cache_readable_by_others_is_ignored(tmp_path, logins, mode):
+    path = str(tmp_path / "token.json")
+    write_cache(path, {"uid@https://dcos/acs/api/v1/auth/login": make_token({"exp": time.time() + 3600})}, mode)
+    assert new_token(path).token is None
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid") or os.getuid() != 0, reason="changing file owners needs root")
+def test_cache_owned_by_someone_else_is_ignored(tmp_path):
+    path = str(tmp_path / "token.json")
+    write_cache(path, {"uid@https://dcos/acs/api/v1/auth/login": make_token({"exp": time.time() + 3600})})
+    os.chown(path, 4242, -1)
+    assert new_token(path).token is None
+
+
+def test_cache_behind_a_symlink_is_ignored(tmp_path):
+    target = str(tmp_path / "elsewhere.json")
+    write_cache(target, {"uid@https://dcos/acs/api/v1/auth/login": make_token({"exp": time.time() + 3600})})
+    path = str(tmp_path / "token.json")
+    os.symlink(target, path)
+    assert new_token(path).token is None
+
+
+def test_login_is_stored_owner_only_keeping_other_accounts(tmp_path, logins):
+    path = str(tmp_path / "token.json")
+    write_cache(path, {"other@x": "theirs"})
+    fresh = make_token({"exp": time.time() + 3600})
+    logins(fresh)
+    assert new_token(path).get() == fresh
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    with open(path) as f:
+        assert json.load(f) == {"other@x": "theirs", "uid@https://dcos/acs/api/v1/auth/login": fresh}
+
+
+def test_concurrent_callers_share_one_login(logins):
+    fresh = make_token({"exp": time.time() + 3600})
+    login = logins(fresh, delay=0.2)
+    token = new_token()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(token.get())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert login.calls == 1
+    assert results == [fresh] * 8
+
+
+def test_waiters_share_a_failed_login(logins):
+    login = logins(delay=0.2)
+    token = new_token()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(token.get())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert login.calls == 1
+    assert results == [None] * 8
+
+
+def test_failed_login_backs_off(logins, monkeypatch):
+    now = [500.0]
+    monkeypatch.setattr(mesos_collectd.time, "monotonic", lambda: now[0])
+    fresh = make_token({"exp": time.time() + 3600})
+    login = logins(None, None, fresh)
+    token = new_token()
+    assert token.get() is None
+    assert token.get() is None
+    assert login.calls == 1
+    now[0] += mesos_collectd.DCOS_LOGIN_BACKOFF
+    assert token.get() is None
+    assert login.calls == 2
+    # The backoff doubles after each failure
+    now[0] += mesos_collectd.DCOS_LOGIN_BACKOFF
+    assert token.get() is None
+    assert login.calls == 2
+    now[0] += mesos_collectd.DCOS_LOGIN_BACKOFF
+    assert token.get() == fresh
+    assert login.calls == 3
+    assert token.backoff == mesos_collectd.DCOS_LOGIN_BACKOFF
+    assert token.retry_at is None
+
+
+def test_login_backoff_is_capped(logins, monkeypatch):
+    now = [500.0]
+    monkeypatch.setattr(mesos_collectd.time, "monotonic", lambda: now[0])
+    login = logins()
+    token = new_token()
+    for _ in range(20):
+        token.get()
+        now[0] += mesos_collectd.DCOS_LOGIN_MAX_BACKOFF
+    assert login.calls == 20
+    assert token.backoff == mesos_collectd.DCOS_LOGIN_MAX_BACKOFF
+
+
+def test_expired_token_is_replaced(logins):
+    fresh = make_token({"exp": time.time() + 3600})
+    logins(make_token({"exp": time.time() - 1}), fresh)
+    token = new_token()
+    token.get()
+    assert token.get() == fresh
+
+
+def test_token_close_to_expiry_is_refreshed_in_background(logins, monkeypatch):
+    soon = make_token({"exp": time.time() + mesos_collectd.DCOS_TOKEN_REFRESH_MARGIN / 2})
+    logins(soon)
+    token = new_token()
+    assert token.get() == soon
+    stale = []
+    monkeypatch.setattr(token, "refresh_in_background", stale.append)
+    assert token.get() == soon
+    assert stale == [soon]
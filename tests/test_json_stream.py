@@ -0,0 +1,123 @@
+import io
+import json
+import zlib
+
+import pytest
+
+import mesos_collectd
+
+
+class RecordingReader(io.BytesIO):
+    """BytesIO that remembers the size of every read"""
+
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.sizes = []
+        self.closed_by_stream = False
+
+    def read(self, size=-1):
+        self.sizes.append(size)
+        return io.BytesIO.read(self, size)
+
+    def close(self):
+        self.closed_by_stream = True
+
+
+DOCUMENT = {
+    "frameworks": [
+        {"id": "f-1", "name": "café ☃", "quoted": 'a "b" \\ c\n', "cpus": 0.25, "ports": [31000, 31001]},
+        {"id": "f-2", "name": "", "nested": {"deep": [[], {}, [1.5e3, -2, True, False, None]]}},
+        {"id": "f-3", "count": 1234567890123},
+    ],
+    "version": "1.7.0",
+    "empty": [],
+    "tasks": [{"id": "t-1"}],
+}
+
+
+def read_document(data, chunk_size, head=b""):
+    reader = mesos_collectd.JSONStreamReader(io.BytesIO(data), chunk_size=chunk_size, head=head)
+    result = {}
+    for key in reader.iter_keys():
+        if reader.peek() == "[":
+            result[key] = list(reader.iter_array())
+        else:
+            result[key] = reader.decode_value()
+    return result
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 16])
+def test_values_split_across_chunks(chunk_size):
+    data = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+    assert read_document(data, chunk_size) == DOCUMENT
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5])
+def test_escaped_and_multibyte_strings(chunk_size):
+    data = json.dumps({"a": ["\\u00e9", "é\U0001f600", '\\"', "\t"]}, ensure_ascii=False).encode("utf-8")
+    assert read_document(data, chunk_size) == {"a": ["\\u00e9", "é\U0001f600", '\\"', "\t"]}
+
+
+def test_number_at_chunk_end_is_not_cut_short():
+    assert read_document(b'{"a": [12345678]}', chunk_size=9) == {"a": [12345678]}
+
+
+def test_whitespace_and_empty_containers():
+    assert read_document(b' \n{ "a" : [ ] ,\t"b" : [ 1 , 2 ] }\n', chunk_size=2) == {"a": [], "b": [1, 2]}
+    assert read_document(b"{}", chunk_size=1) == {}
+
+
+def test_head_is_scanned_before_the_file():
+    data = json.dumps(DOCUMENT).encode("utf-8")
+    assert read_document(data[100:], chunk_size=3, head=data[:100]) == DOCUMENT
+
+
+def test_read_size_doubles_while_a_value_is_incomplete():
+    element = {"id": "x" * 100000}
+    fp = RecordingReader(json.dumps({"frameworks": [element, {"id": "y"}]}).encode("utf-8"))
+    reader = mesos_collectd.JSONStreamReader(fp, chunk_size=1024)
+    assert next(reader.iter_keys()) == "frameworks"
+    elements = reader.iter_array()
+    assert next(elements) == element
+    growing = [size for size in fp.sizes if size > 1024]
+    assert growing == [1024 << n for n in range(1, len(growing) + 1)]
+    assert len(fp.sizes) < 12
+    del fp.sizes[:]
+    assert next(elements) == {"id": "y"}
+    # The next value starts over from the configured chunk size
+    assert all(size == 1024 for size in fp.sizes)
+
+
+@pytest.mark.parametrize("data", [b'{"a": [1, 2', b'{"a": [1 2]}', b'{"a" [1]}', b"[1]", b'{"a": [nope]}'])
+def test_malformed_documents_raise_value_error(data):
+    with pytest.raises(ValueError):
+        read_document(data, chunk_size=2)
+
+
+def test_array_stream_yields_only_its_key():
+    data = json.dumps(DOCUMENT).encode("utf-8")
+    fp = RecordingReader(data)
+    stream = mesos_collectd.JSONArrayStream(fp, "frameworks", "http://master/frameworks")
+    assert list(stream) == DOCUMENT["frameworks"]
+    assert stream.complete
+    assert fp.closed_by_stream
+
+
+def test_array_stream_marks_truncated_body_incomplete():
+    data = json.dumps(DOCUMENT).encode("utf-8")
+    fp = RecordingReader(data[: data.index(b'"f-3"')])
+    stream = mesos_collectd.JSONArrayStream(fp, "frameworks", "http://master/frameworks")
+    assert list(stream) == DOCUMENT["frameworks"][:2]
+    assert not stream.complete
+    assert fp.closed_by_stream
+
+
+def test_array_stream_logs_corrupt_compressed_body():
+    def corrupt(size=-1):
+        raise zlib.error("invalid stored block lengths")
+
+    fp = RecordingReader(b"")
+    fp.read = corrupt
+    stream = mesos_collectd.JSONArrayStream(fp, "tasks", "http://master/tasks")
+    assert list(stream) == []
+    assert not stream.complete
@@ -0,0 +1,144 @@
+import collections
+
+import pytest
+
+import mesos_collectd
+
+Plan = collections.namedtuple("Plan", ("stats",))
+
+
+def make_conf(templates=mesos_collectd.DEFAULT_STAT_TEMPLATES, **options):
+    conf = {
+        "prefix": "mesos-master",
+        "instance": "master-0",
+        "cluster": "cluster-0",
+        "is_master": True,
+        "verboseLogging": False,
+        "stat_templates": list(templates),
+    }
+    conf.update(options)
+    return conf
+
+
+@pytest.mark.parametrize(
+    "key, expected",
+    [
+        ("allocator/mesos/roles/web/shares/dominant", ("allocator/mesos/roles/shares/dominant", (("role", "web"),))),
+        (
+            "allocator/mesos/quota/roles/db/resources/cpus/guarantee",
+            ("allocator/mesos/quota/roles/resources/cpus/guarantee", (("role", "db"),)),
+        ),
+        (
+            "master/frameworks/marathon/abc-0001/calls/accept",
+            (
+                "master/frameworks/calls/accept",
+                (("framework", "marathon"), ("mesos_framework_id", "abc-0001")),
+            ),
+        ),
+        ("registrar/state_store_ms/p99", ("registrar/state_store_ms", (("quantile", "p99"),))),
+        ("allocator/mesos/allocation_run_ms/count", ("allocator/mesos/allocation_run_ms", (("quantile", "count"),))),
+        ("master/uptime_secs", None),
+        ("registrar/state_store_ms/p9x", None),
+    ],
+)
+def test_default_templates(key, expected):
+    assert mesos_collectd.parse_templated_key(make_conf(), key) == expected
+
+
+def test_literal_text_is_escaped():
+    template = mesos_collectd.compile_stat_template("a.b/{x}")
+    assert template.match("a.b/1")
+    assert not template.match("aXb/1")
+    assert template.dimensions == ("x",)
+
+
+def test_default_capture_is_one_segment_and_the_whole_key_must_match():
+    template = mesos_collectd.compile_stat_template("a/{x}/c")
+    assert template.match("a/b/c")
+    assert not template.match("a/b/b/c")
+    assert not template.match("a/b/c/d")
+
+
+def test_star_matches_across_segments():
+    template = mesos_collectd.compile_stat_template("a/*/{x}")
+    assert template.match("a/b/c/d").group("x") == "d"
+
+
+def test_capture_at_the_start_drops_the_following_separator():
+    conf = make_conf(["{cluster}/requests"])
+    assert mesos_collectd.parse_templated_key(conf, "east/requests") == ("requests", (("cluster", "east"),))
+
+
+def test_first_matching_template_wins():
+    conf = make_conf(["a/{first}/*", "a/*/{second}"])
+    assert mesos_collectd.parse_templated_key(conf, "a/b/c") == ("a/c", (("first", "b"),))
+
+
+def test_invalid_template_is_skipped_with_a_warning(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(mesos_collectd.collectd, "warning", warnings.append)
+    conf = make_conf(["a/{x:[}", "a/{y}"])
+    assert mesos_collectd.parse_templated_key(conf, "a/b") == ("a", (("y", "b"),))
+    assert len(warnings) == 1 and "a/{x:[}" in warnings[0]
+
+
+def test_results_are_cached_and_the_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(mesos_collectd, "TEMPLATE_CACHE_SIZE", 3)
+    conf = make_conf(["a/{x}"])
+    for key in ("a/1", "a/2", "b/3"):
+        mesos_collectd.parse_templated_key(conf, key)
+    assert conf["template_cache"] == {"a/1": ("a", (("x", "1"),)), "a/2": ("a", (("x", "2"),)), "b/3": None}
+    mesos_collectd.parse_templated_key(conf, "a/4")
+    assert conf["template_cache"] == {"a/4": ("a", (("x", "4"),))}
+
+
+SNAPSHOT = {
+    "master/uptime_secs": 10.0,
+    "master/elected": 1.0,
+    "registrar/state_store_ms/p99": 3.5,
+    "allocator/mesos/roles/web/shares/dominant": 0.5,
+    "master/version": "1.7.0",
+    "master/flag": True,
+}
+
+
+def uptime_plan():
+    key = "master/uptime_secs"
+    planned = mesos_collectd.PlannedStat(
+        "master.uptime", mesos_collectd.Stat("gauge", key), (key,), None, mesos_collectd.compile_accessor((key,))
+    )
+    return Plan((planned,))
+
+
+def describe(stats):
+    return sorted((planned.name, planned.key.type, planned.get(SNAPSHOT), instance) for planned, instance in stats)
+
+
+def test_templates_complement_the_table_stats():
+    stats = mesos_collectd.get_snapshot_stats(make_conf(), uptime_plan(), SNAPSHOT)
+    assert describe(stats) == [
+        (
+            "allocator/mesos/roles/shares/dominant",
+            "gauge",
+            0.5,
+            "master-0[role=web,plugin_type=master,cluster=cluster-0]",
+        ),
+        ("master.uptime", "gauge", 10.0, None),
+        ("registrar/state_store_ms", "gauge", 3.5, "master-0[quantile=p99,plugin_type=master,cluster=cluster-0]"),
+    ]
+
+
+def test_discovery_sends_every_numeric_key_and_keeps_table_names():
+    conf = make_conf(discover_stats=True, stats_exclude=["*/elected"])
+    stats = mesos_collectd.get_snapshot_stats(conf, uptime_plan(), SNAPSHOT)
+    names = [name for name, _, _, _ in describe(stats)]
+    assert names == ["allocator/mesos/roles/shares/dominant", "master.uptime", "registrar/state_store_ms"]
+
+
+def test_snapshot_stats_are_rebuilt_only_when_keys_change():
+    conf = make_conf()
+    plan = uptime_plan()
+    stats = mesos_collectd.get_snapshot_stats(conf, plan, SNAPSHOT)
+    assert mesos_collectd.get_snapshot_stats(conf, plan, dict(SNAPSHOT)) is stats
+    changed = dict(SNAPSHOT, **{"registrar/state_store_ms/p50": 1.0})
+    assert mesos_collectd.get_snapshot_stats(conf, plan, changed) is not stats
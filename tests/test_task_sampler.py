@@ -0,0 +1,110 @@
+import importlib.util
+import os
+import zlib
+
+import pytest
+
+import collectd
+import mesos_collectd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def task(task_id, framework_id="f-1"):
+    return {"id": task_id, "framework_id": framework_id}
+
+
+def below(task_id, rate):
+    return zlib.crc32(str(task_id).encode("utf-8")) < rate * 2**32
+
+
+def test_full_rate_sends_every_task_unweighted():
+    sampler = mesos_collectd.TaskSampler(1.0, [])
+    assert all(sampler.sample(task("t-%d" % i)) == (True, None) for i in range(100))
+
+
+def test_zero_rate_sends_nothing():
+    sampler = mesos_collectd.TaskSampler(0.0, [])
+    assert not any(sampler.sample(task("t-%d" % i))[0] for i in range(100))
+
+
+def test_tasks_below_the_crc32_threshold_are_sent_with_their_weight():
+    sampler = mesos_collectd.TaskSampler(0.25, [])
+    for i in range(1000):
+        task_id = "t-%d" % i
+        assert sampler.sample(task(task_id)) == (below(task_id, 0.25), "4")
+
+
+def test_sampled_fraction_follows_the_rate():
+    sampler = mesos_collectd.TaskSampler(0.1, [])
+    sampled = sum(sampler.sample(task("task-%d" % i))[0] for i in range(20000))
+    assert 1700 < sampled < 2300
+
+
+def test_selection_is_stable_across_samplers():
+    first = mesos_collectd.TaskSampler(0.3, [])
+    second = mesos_collectd.TaskSampler(0.3, [])
+    ids = ["app.%08x" % (i * 2654435761 % 2**32) for i in range(500)]
+    assert [first.sample(task(i)) for i in ids] == [second.sample(task(i)) for i in ids]
+
+
+def test_non_string_task_ids_are_hashed_as_strings():
+    sampler = mesos_collectd.TaskSampler(0.5, [])
+    assert sampler.sample(task(12345)) == (below("12345", 0.5), "2")
+
+
+def test_first_matching_framework_pattern_sets_the_rate():
+    sampler = mesos_collectd.TaskSampler(0.5, [("keep-*", 1.0), ("*-0001", 0.0), ("keep-0001", 0.0)])
+    assert sampler.sample(task("t", "keep-0001")) == (True, None)
+    assert sampler.sample(task("t", "other-0001")) == (False, None)
+    assert sampler.sample(task("t", "other-0002")) == (below("t", 0.5), "2")
+
+
+def test_rates_outside_zero_to_one_are_clamped():
+    sampler = mesos_collectd.TaskSampler(2.0, [("none", -1.0)])
+    assert sampler.sample(task("t")) == (True, None)
+    assert sampler.sample(task("t", "none")) == (False, None)
+
+
+@pytest.fixture
+def master_conf(monkeypatch):
+    monkeypatch.setattr(mesos_collectd, "get_version_from_api", lambda url, conf: "1.7.0")
+    spec = importlib.util.spec_from_file_location("mesos_master", os.path.join(ROOT, "mesos-master.py"))
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    configs = len(mesos_collectd.CONFIGS)
+    options = [("Host", "127.0.0.1"), ("Port", 5050), ("TaskSampleRate", 0.5), ("FrameworkSampleRate", "keep-*", 1.0)]
+    plugin.configure_callback(collectd.Config("Module", children=[collectd.Config(o[0], o[1:]) for o in options]))
+    conf = mesos_collectd.CONFIGS[-1]
+    conf["elected"] = 1
+    yield conf
+    del mesos_collectd.CONFIGS[configs:]
+
+
+def test_weight_dimension_marks_sampled_down_frameworks(master_conf, monkeypatch):
+    sent = []
+    monkeypatch.setattr(collectd.Values, "dispatch", lambda self, **values: sent.append(values))
+    tasks = [
+        {
+            "id": "t-%d" % i,
+            "name": "web",
+            "framework_id": "keep-1" if i % 2 else "drop-1",
+            "slave_id": "s-1",
+            "state": "TASK_RUNNING",
+            "resources": {"cpus": 1.0},
+        }
+        for i in range(40)
+    ]
+    assert mesos_collectd.parse_task_stats(master_conf, {"tasks": tasks}) == 40
+    states = {}
+    for values in sent:
+        if values["type_instance"] == "task.state":
+            instance = values["plugin_instance"]
+            states[instance.split("mesos_task_id=")[1].split(",")[0]] = instance
+    expected = [t["id"] for t in tasks if t["framework_id"] == "keep-1" or below(t["id"], 0.5)]
+    assert sorted(states) == sorted(expected)
+    for task_id, instance in states.items():
+        weighted = "task_sample_weight=2," in instance
+        assert weighted == (int(task_id[2:]) % 2 == 0)
+    # The total still counts every task
+    assert [v["values"] for v in sent if v["type_instance"] == "task.total"] == [[40]]